@@ -0,0 +1,136 @@
+"""
+Nightly backup, in two parts:
+
+ * a copy of the database in backup.db, taken with SQLite's online backup
+   API in a single step: in WAL mode that only holds a read snapshot, so
+   the explorer and the web server carry on writing meanwhile;
+ * an append-only archive of gzipped CSV chunks, each holding only the rows
+   which changed since the previous chunk, listed in archive/manifest.json.
+   Replaying the chunks in order reproduces the whole database.
+
+With --snapshot it also rewrites the full backup.csv.gz, from the copy
+rather than the live database. That takes time in proportion to the whole
+database rather than the day's changes, so backup.sh only asks for it
+once a week.
+"""
+
+import argparse
+import csv
+import database
+import io
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+COPY = "backup.db"
+ARCHIVE = "archive"
+SNAPSHOT = "backup.csv.gz"
+
+
+def csv_gzip(rows, chunk_size=1 << 16):
+    "gzip a CSV file on the fly, in the same format as backup.csv.gz"
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    buffer = io.StringIO()
+    out = csv.writer(buffer)
+    for buttons, screen, *rest in rows:
+        screen = "NULL" if screen is None else f"X'{screen.hex().upper()}'"
+        out.writerow([buttons, screen, *rest])
+        if buffer.tell() > chunk_size:
+            yield compressor.compress(buffer.getvalue().encode())
+            buffer.seek(0)
+            buffer.truncate()
+    yield compressor.compress(buffer.getvalue().encode()) + compressor.flush()
+
+
+def write_atomically(path, chunks, mode="wb"):
+    partial = f"{path}.partial"
+    with open(partial, mode) as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(partial, path)
+
+
+def copy_database(source, path=COPY):
+    """
+    Copy the live database as of one moment. This has to be done in one
+    step: a backup taken in several restarts whenever anyone else writes
+    in between, and with the explorer committing every few seconds a large
+    one might never finish.
+    """
+    partial = f"{path}.partial"
+    if os.path.exists(partial):
+        os.remove(partial)
+    target = sqlite3.connect(partial)
+    source.backup(target)
+    target.close()
+    os.replace(partial, path)
+
+
+def load_manifest(archive=ARCHIVE):
+    try:
+        with open(os.path.join(archive, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"chunks": []}
+
+
+def append_chunk(con, archive=ARCHIVE):
+    "archive the rows which changed since the last chunk, if there are any"
+    manifest = load_manifest(archive)
+    since = manifest["chunks"][-1]["until"] if manifest["chunks"] else 0
+    until = database.cursor(con)
+    if until <= since:
+        logging.info("nothing changed since the last chunk")
+        return None
+    count = 0
+
+    def counted():
+        nonlocal count
+        for row in database.changes(con, since, until):
+            count += 1
+            yield row
+
+    name = f"changes-{since + 1:012}-{until:012}.csv.gz"
+    os.makedirs(archive, exist_ok=True)
+    write_atomically(os.path.join(archive, name), csv_gzip(counted()))
+    manifest["chunks"].append(
+        {"file": name, "since": since, "until": until, "rows": count}
+    )
+    write_atomically(
+        os.path.join(archive, "manifest.json"),
+        [json.dumps(manifest, indent=1)],
+        mode="w",
+    )
+    logging.info(f"archived {count} changed rows in {name}")
+    return name
+
+
+def write_snapshot(con, path=SNAPSHOT):
+    "the full CSV, shortest sequences first"
+    rows = con.execute(
+        """SELECT buttons, screen, requested, changed FROM sessions
+        ORDER BY LENGTH(buttons), buttons"""
+    )
+    write_atomically(path, csv_gzip(rows))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--snapshot", action="store_true", help=f"also rewrite {SNAPSHOT}"
+    )
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    copy_database(database.connect())
+    logging.info(f"copied database in {time.monotonic() - start:.1f} seconds")
+    # everything else reads the copy, and leaves the live database alone
+    copy = database.connect(COPY)
+    append_chunk(copy)
+    if args.snapshot:
+        write_snapshot(copy)
+        logging.info(f"wrote {SNAPSHOT}")
@@ -1,4 +1,11 @@
 #! /bin/bash
-rm backup.db
-sqlite3 --cmd ".timeout 60000" xanthippe.db "VACUUM INTO 'backup.db';"
-sqlite3 backup.db --csv "SELECT buttons, QUOTE(screen) AS screen, requested FROM sessions ORDER BY LENGTH(buttons), buttons;" | gzip > backup.csv.gz
+# Every night: copy the database and archive the rows changed since the
+# last run. The full backup.csv.gz which listen.py serves, and the compact
+# export, take time in proportion to the whole database, so they are only
+# rebuilt once the snapshot is a week old; the archive is always current.
+if [ -n "$(find backup.csv.gz -mtime -7 2>/dev/null)" ]; then
+    exec python3 backup.py "$@"
+fi
+python3 backup.py --snapshot "$@" || exit
+# the compact export, from the copy backup.py has just taken
+exec python3 export.py --db backup.db
@@ -0,0 +1,108 @@
+"""
+Decoding speed: raw LCD rows to screens, and screens to text, comparing
+the table-driven decoders (one at a time, and batched through numpy)
+with the string-based ones they replaced. Every decoder has to agree.
+
+    python -m benchmarks.decode [--frames 20000] [--db xanthippe.db]
+
+With --db the screens come from the database rather than at random.
+"""
+
+import argparse
+import random
+import sqlite3
+import time
+
+from calculator import DIGITS, SYMBOLS, Screen, texts, unpack
+from driver.lcdreader import normalize_reading, normalize_readings
+
+
+def old_normalize_reading(bits):
+    rows = [f"{x>>4:028b}" for x in bits]
+    columns = zip(*rows)
+    paired = zip(*[iter(columns)] * 2)
+    return bytes(int("".join(a + b), base=2) for a, b in paired)
+
+
+def old_digit(x):
+    # the old SevenSegment.__str__ built its dict for every digit
+    try:
+        return dict(SYMBOLS)[x & 0x7F] + ("." if x & 0x80 else " ")
+    except KeyError:
+        raise ValueError(f"no symbol for bitmap {x:08b}")
+
+
+def old_text(screen):
+    s = {}
+    s["STAT "], s["DE"], s["G"], s["FIX "], s["R "], s["X"], s["RAD "], e2g = unpack(
+        screen[0]
+    )
+    s["K"] = screen[1] & 0x80
+    s["() "] = screen[2] & 0x80
+    s["M3 "], g10, s["M2 "], s["M1 "], s["2nd "], s["HYP "], s["ENG "], s["SCI"] = (
+        unpack(screen[13])
+    )
+    order = "M1 |M2 |M3 |2nd |HYP |SCI|ENG |FIX |STAT |DE|G|RAD |X|R |() |K"
+    row1 = "".join(x if s[x] else " " * len(x) for x in order.split("|"))
+    row2 = (
+        ("-" if g10 else " ")
+        + "".join(old_digit(x) for x in screen[12:2:-1])
+        + (" -" if e2g else "  ")
+        + "".join(old_digit(x)[0] for x in screen[2:0:-1])
+    )
+    return f"{row1}\n{row2}"
+
+
+def or_none(decode, screen):
+    try:
+        return decode(screen)
+    except ValueError:
+        return None
+
+
+def timed(name, n, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    print(f"{name:<28}{n / seconds:>14,.0f} per second")
+    return result
+
+
+def random_screens(n):
+    valid = [b for b in range(256) if DIGITS[b] is not None]
+    return [
+        bytes([random.randrange(256)])
+        + bytes(random.choices(valid, k=12))
+        + bytes([random.randrange(256)])
+        for __ in range(n)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the LCD decoders")
+    parser.add_argument("--frames", type=int, default=20000)
+    parser.add_argument("--db", help="decode the screens in this database")
+    args = parser.parse_args()
+
+    rows = [[random.getrandbits(32) for __ in range(4)] for __ in range(args.frames)]
+    n = len(rows)
+    old = timed(
+        "old normalize_reading", n, lambda: list(map(old_normalize_reading, rows))
+    )
+    new = timed("normalize_reading", n, lambda: list(map(normalize_reading, rows)))
+    batch = timed("normalize_readings (numpy)", n, normalize_readings, rows)
+    assert old == new == [row.tobytes() for row in batch]
+
+    if args.db:
+        con = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+        screens = [s for (s,) in con.execute("SELECT screen FROM screens")]
+        screens = [s for s in screens if len(s) == 14]
+    else:
+        screens = random_screens(args.frames)
+    n = len(screens)
+    old = timed(
+        "old Screen.__str__", n, lambda: [or_none(old_text, s) for s in screens]
+    )
+    new = timed("Screen.__str__", n, lambda: [or_none(str, Screen(s)) for s in screens])
+    batch = timed("texts (numpy)", n, texts, screens)
+    assert old == new == batch
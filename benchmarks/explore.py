@@ -0,0 +1,126 @@
+"""
+End-to-end throughput: the explorer running on simulated rigs against a
+temporary database, reporting keys and sessions per second, how long
+database writes take, and how many display frames the reader lost,
+leaving out any the simulator sent late.
+
+    python -m benchmarks.explore [--seconds 60] [--rigs 2] [--latency 0.02]
+
+--metrics adds the timings from metrics.py, at whatever they cost.
+
+The presser's timings are the real ones, so these are the rates a Pi
+would get, less whatever the hardware adds.
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import database
+import explore
+import metrics
+from simulator import Model, Simulator
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)] if values else 0
+
+
+def timing(func, durations):
+    "func, recording how long each call takes in durations"
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            durations.append(time.perf_counter() - start)
+
+    return timed
+
+
+def counting(session, keys):
+    "session, adding the length of each target to keys"
+
+    def counted(codes):
+        keys.append(len(codes))
+        return session(codes)
+
+    return counted
+
+
+def run(seconds, rigs, latency):
+    path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    con = database.connect(path)
+    with con:
+        # the request strategies need something to work from
+        database.request(con, ["TCbi", "jKUi", "sqrt"])
+    writes = []
+    database.record = timing(database.record, writes)
+    keys = []
+    ex = explore.Explorer(
+        [{"name": f"sim{i}", "gpio": "mock", "display": None} for i in range(rigs)],
+        path,
+    )
+    for rig in ex.rigs:
+        calculator = rig.calculator
+        calculator.simulator = Simulator(calculator, Model(latency=latency))
+        calculator.session = counting(calculator.session, keys)
+
+    end = time.monotonic() + seconds
+
+    def work(rig):
+        while time.monotonic() < end and not rig.quarantined:
+            ex.explore(rig)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=work, args=[rig]) for rig in ex.rigs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ex.writer.flush()
+    elapsed = time.monotonic() - start
+
+    print(f"{rigs} rigs, {elapsed:.1f} seconds, compute latency {latency}s")
+    print(f"  sessions   {ex.sessions / elapsed:8.2f}/s")
+    print(f"  keys       {sum(keys) / elapsed:8.2f}/s (target keys only)")
+    presses = sum(rig.calculator.simulator.model.presses for rig in ex.rigs)
+    print(f"  presses    {presses / elapsed:8.2f}/s (resets included)")
+    print(
+        f"  db writes  {len(writes)}, p50 {percentile(writes, 0.5) * 1e3:.1f} ms, "
+        f"p99 {percentile(writes, 0.99) * 1e3:.1f} ms"
+    )
+    for rig in ex.rigs:
+        calculator = rig.calculator
+        reader, bus = calculator.reader, calculator.simulator.bus
+        bus.stop()
+        print(
+            f"  {calculator.name}: {bus.frames} frames sent ({bus.late} late), "
+            f"{reader.dropped} rows dropped, {reader.partial - bus.late} partial "
+            f"frames, {reader.bad_checksum} bad checksums; {calculator.resets}"
+        )
+    for line in metrics.summary():
+        print(f"  {line}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the explorer")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--rigs", type=int, default=1)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="seconds the model computes"
+    )
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument(
+        "--metrics", action="store_true", help="time the hot paths, see metrics.py"
+    )
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.enable()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    run(args.seconds, args.rigs, args.latency)
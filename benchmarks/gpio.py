@@ -0,0 +1,80 @@
+"""
+How fast each GPIO backend clocks in the LCD's shift register, and how
+many frames the reader loses at the calculator's refresh rate.
+
+    python -m benchmarks.gpio --backend mock gpiozero --seconds 5
+
+With the mock backend the display is simulated, see simulator.Bus; frames
+the simulator itself sent late are left out of the loss.
+On a Pi with a rig attached, --live counts the frames the real display
+delivers instead; without it only the bit rate is measured, as nothing
+sensible is on the data line.
+"""
+
+import argparse
+import time
+
+from driver import gpio
+from driver.lcdreader import LCDReader, LCD_REFRESH_PERIOD, default_pins
+from simulator import Bus
+
+# "DEG 34"
+SCREEN = bytes.fromhex("600000637a000000000000000000")
+
+
+def bit_rate(reader, seconds):
+    clock, data = reader.pins["clock"], reader.pins["data"]
+    words = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        reader.gpio.shift_in(clock, data, 32)
+        words += 1
+    return words * 32 / seconds
+
+
+def frames_simulated(reader, seconds):
+    "drive the reader from a simulated display; returns the frames sent, and late"
+    bus = Bus(reader, lambda: SCREEN)
+    time.sleep(seconds)
+    bus.stop()
+    # let the capture thread catch up
+    time.sleep(0.1)
+    return bus.frames, bus.late
+
+
+def frames_live(reader, seconds):
+    time.sleep(seconds)
+    return round(seconds * 1e9 / LCD_REFRESH_PERIOD), 0
+
+
+def run(name, seconds, live):
+    reader = LCDReader(default_pins, gpio.backend(name))
+    print(f"{name}: {bit_rate(reader, seconds) / 1e3:.1f} kbit/s")
+    if name != "mock" and not live:
+        return
+    # a steady display only extends the newest run, so count from its frames
+    first = max(reader.log.count - 1, 0)
+    newest = reader.log.read(first)
+    before = newest.frames if newest else 0
+    sent, late = (frames_live if live else frames_simulated)(reader, seconds)
+    received = sum(entry.frames for entry in reader.log.entries(since=first))
+    received -= before
+    sent -= late
+    print(
+        f"{name}: {received}/{sent} frames, {1 - received / sent:.2%} lost "
+        f"({reader.dropped} rows dropped, {reader.partial - late} partial frames, "
+        f"{reader.bad_checksum} bad checksums; {late} more sent late by the "
+        f"simulator)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the GPIO backends")
+    parser.add_argument("--backend", nargs="+", default=["mock"], choices=gpio.BACKENDS)
+    parser.add_argument("--seconds", type=float, default=2)
+    parser.add_argument(
+        "--live", action="store_true", help="count frames from the real display"
+    )
+    args = parser.parse_args()
+    for name in args.backend:
+        run(name, args.seconds, args.live)
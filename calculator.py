@@ -3,12 +3,14 @@
 'TCbi3'
 """
 
+from driver import display, buttonpresser, gpio, lcdreader
 from driver.display import LCD
 from driver.buttonpresser import ButtonPresser
 from driver.lcdreader import LCDReader
 import json
 from dataclasses import dataclass
 import logging
+import metrics
 import time
 
 with open("button_codes.json") as f:
@@ -16,6 +18,46 @@ with open("button_codes.json") as f:
 
 BUTTON_NAMES = {val: key for key, val in BUTTON_CODES.items()}
 
+# how long to wait for the display to react to a key before falling back
+# on whatever it shows, and how many identical frames count as settled
+SETTLE_SECONDS = 0.25
+SETTLE_FRAMES = 3
+# I timed the calculator at 9 seconds to do 300 choose 150
+MAX_COMPUTE_SECONDS = 10
+
+
+SYMBOLS = {
+    ##cbadegf
+    0b0000000: " ",
+    0b1100000: "1",
+    0b0111110: "2",
+    0b1111010: "3",
+    0b1100011: "4",
+    0b1011011: "5",
+    0b1011111: "6",
+    0b1110001: "7",
+    0b1111111: "8",
+    0b1111011: "9",
+    0b1111101: "0",
+    0b0011111: "E",
+    0b0000110: "r",
+    0b1001110: "o",
+    0b0001111: "t",
+    0b1110111: "A",
+    0b0001000: "_",
+    0b0001010: "=",
+    0b1001000: "/",
+    0b0100001: '"',
+    0b0000001: "'",
+    0b1000110: "n",
+    0b0000010: "-",
+}
+# what each byte shows, decimal point included, or None if it is no symbol
+DIGITS = [
+    SYMBOLS[b & 0x7F] + ("." if b & 0x80 else " ") if b & 0x7F in SYMBOLS else None
+    for b in range(256)
+]
+
 
 class SevenSegment(int):
     """
@@ -46,42 +88,42 @@ class SevenSegment(int):
         ...
         ValueError: no symbol for bitmap 00000011
         """
-        dp = "." if self.dp() else " "
-        try:
-            return {
-                ##cbadegf
-                0b0000000: " ",
-                0b1100000: "1",
-                0b0111110: "2",
-                0b1111010: "3",
-                0b1100011: "4",
-                0b1011011: "5",
-                0b1011111: "6",
-                0b1110001: "7",
-                0b1111111: "8",
-                0b1111011: "9",
-                0b1111101: "0",
-                0b0011111: "E",
-                0b0000110: "r",
-                0b1001110: "o",
-                0b0001111: "t",
-                0b1110111: "A",
-                0b0001000: "_",
-                0b0001010: "=",
-                0b1001000: "/",
-                0b0100001: '"',
-                0b0000001: "'",
-                0b1000110: "n",
-                0b0000010: "-",
-            }[self & 0x7F] + dp
-        except KeyError:
+        digit = DIGITS[self & 0xFF]
+        if digit is None:
             raise ValueError(f"no symbol for bitmap {self:08b}")
+        return digit
 
 
 def unpack(byte):
     return (bool(int(c)) for c in f"{byte:08b}")
 
 
+def indicators(bits, order):
+    """
+    What row one shows for each value of a byte whose bits, most significant
+    first, light the indicators in `bits`; `order` is the order the screen
+    shows them in.
+    """
+    table = []
+    for byte in range(256):
+        lit = {name for name, on in zip(bits, unpack(byte)) if on}
+        table.append("".join(x if x in lit else " " * len(x) for x in order))
+    return table
+
+
+# the bits of bytes 13 and 0 which are minus signs on row two
+G10 = 0x40
+E2G = 0x01
+INDICATORS_13 = indicators(
+    ["M3 ", None, "M2 ", "M1 ", "2nd ", "HYP ", "ENG ", "SCI"],
+    ["M1 ", "M2 ", "M3 ", "2nd ", "HYP ", "SCI", "ENG "],
+)
+INDICATORS_0 = indicators(
+    ["STAT ", "DE", "G", "FIX ", "R ", "X", "RAD ", None],
+    ["FIX ", "STAT ", "DE", "G", "RAD ", "X", "R "],
+)
+
+
 class Screen(bytes):
     def __str__(self):
         r"""
@@ -92,66 +134,187 @@ class Screen(bytes):
                                          DEG
                          3 4
         """
-        s = {}
-        (
-            s["STAT "],
-            s["DE"],
-            s["G"],
-            s["FIX "],
-            s["R "],
-            s["X"],
-            s["RAD "],
-            e2g,
-        ) = unpack(self[0])
-        exponent = [SevenSegment(x) for x in self[1:3]]
-        s["K"] = exponent[0].dp()
-        s["() "] = exponent[1].dp()
-        mantissa = [SevenSegment(x) for x in self[3:13]]
-        (
-            s["M3 "],
-            g10,
-            s["M2 "],
-            s["M1 "],
-            s["2nd "],
-            s["HYP "],
-            s["ENG "],
-            s["SCI"],
-        ) = unpack(self[13])
-
-        row1 = "".join(
-            x if s[x] else " " * len(x)
-            for x in "M1 |M2 |M3 |2nd |HYP |SCI|ENG |FIX |STAT |DE|G|RAD |X|R |() |K".split(
-                "|"
-            )
+        # bytes 1 and 2 are the exponent, 3 to 12 the mantissa, and the
+        # digit at either end of each is shown first
+        for b in self[12:0:-1]:
+            if DIGITS[b] is None:
+                raise ValueError(f"no symbol for bitmap {b:08b}")
+        row1 = (
+            INDICATORS_13[self[13]]
+            + INDICATORS_0[self[0]]
+            + ("() " if self[2] & 0x80 else "   ")
+            + ("K" if self[1] & 0x80 else " ")
         )
-
         row2 = (
-            ("-" if g10 else " ")
-            + "".join(str(seg) for seg in mantissa[::-1])
-            + (" -" if e2g else "  ")
-            + "".join(str(seg)[0] for seg in exponent[::-1])
+            ("-" if self[13] & G10 else " ")
+            + "".join(DIGITS[b] for b in self[12:2:-1])
+            + (" -" if self[0] & E2G else "  ")
+            + DIGITS[self[2]][0]
+            + DIGITS[self[1]][0]
         )
         return f"{row1}\n{row2}"
 
 
+def texts(screens):
+    r"""
+    str(Screen(s)) for many screens at once, or None for any which do not
+    decode: an (n, 14) array of bytes in, a list of n strings out. Needs
+    numpy.
+
+    >>> texts([b'\xff' * 14, bytes.fromhex("6000000300000000000000000000")])
+    ['M1 M2 M3 2nd HYP SCIENG FIX STAT DEGRAD XR () K\n-8.8.8.8.8.8.8.8.8.8. -88', None]
+    """
+    import numpy
+    from functools import reduce
+
+    screens = numpy.frombuffer(b"".join(map(bytes, screens)), dtype=numpy.uint8)
+    screens = screens.reshape(-1, 14)
+    valid = numpy.array([d is not None for d in DIGITS])[screens[:, 1:13]].all(axis=1)
+    digits = numpy.array([d or "  " for d in DIGITS])
+    first = numpy.array([d[0] for d in digits])
+    parts = [
+        numpy.array(INDICATORS_13)[screens[:, 13]],
+        numpy.array(INDICATORS_0)[screens[:, 0]],
+        numpy.where(screens[:, 2] & 0x80, "() ", "   "),
+        numpy.where(screens[:, 1] & 0x80, "K", " "),
+        numpy.full(len(screens), "\n"),
+        numpy.where(screens[:, 13] & G10, "-", " "),
+        *(digits[screens[:, i]] for i in range(12, 2, -1)),
+        numpy.where(screens[:, 0] & E2G, " -", "  "),
+        first[screens[:, 2]],
+        first[screens[:, 1]],
+    ]
+    text = reduce(numpy.char.add, parts).tolist()
+    return [t if ok else None for t, ok in zip(text, valid)]
+
+
+# DEG, 0.
+RESET_SCREEN = Screen.fromhex("600000fd00000000000000000000")
+
+# ways back to RESET_SCREEN, cheapest first. Clearing keeps memory and
+# modes, but each of those has an indicator, so a clear which ends on
+# RESET_SCREEN has left nothing behind.
+RESETS = {
+    "clear": ["ON/C", "ON/C"],
+    "full": ["reset", "OFF", "ON/C", "reset"],
+    "retry": ["reset", "OFF", "ON/C"],
+}
+
+
+class BadReset(Exception):
+    pass
+
+
+@dataclass
+class ResetStats:
+    "how each session's reset went"
+    skipped: int = 0
+    clear: int = 0
+    full: int = 0
+    retry: int = 0
+    retries: int = 0
+    seconds: float = 0
+
+    def record(self, way, retries, seconds):
+        setattr(self, way, getattr(self, way) + 1)
+        self.retries += retries
+        self.seconds += seconds
+
+    def __str__(self):
+        """
+        >>> stats = ResetStats()
+        >>> stats.record("clear", 0, 0.4)
+        >>> stats.record("full", 2, 2.6)
+        >>> print(stats)
+        resets: 0 skipped, 1 clear, 1 full, 0 retry, 2 retries, 1.50s each
+        """
+        sessions = self.skipped + self.clear + self.full + self.retry
+        return (
+            f"resets: {self.skipped} skipped, {self.clear} clear, {self.full} full, "
+            f"{self.retry} retry, {self.retries} retries, "
+            f"{self.seconds / (sessions or 1):.2f}s each"
+        )
+
+
 class Calculator:
-    def __init__(self):
-        self.display = LCD()
-        self.reader = LCDReader()
-        self.presser = ButtonPresser()
+    """
+    One calculator and the circuits attached to it. `rig` says which pins
+    they are on, for example
+        {"name": "left", "presser": {...}, "reader": {...}, "display": {...}}
+    where each section is a pin map for that driver, defaulting to the
+    driver's own default_pins. An optional "gpio" names the backend the
+    presser and reader use, one of driver.gpio.BACKENDS. "display": null
+    runs without a status display.
+    """
+
+    def __init__(self, rig={}, latencies=None, max_resets=None):
+        self.name = rig.get("name", "calculator")
+        self.display = LCD(rig.get("display", display.default_pins))
+        backend = gpio.backend(rig.get("gpio", "gpiozero"))
+        self.reader = LCDReader(rig.get("reader", lcdreader.default_pins), backend)
+        self.presser = ButtonPresser(
+            rig.get("presser", buttonpresser.default_pins), backend
+        )
+        # optional latency.LatencyModel, used to choose per-key deadlines
+        self.latencies = latencies
+        # give up with BadReset after this many failed resets, if not None
+        self.max_resets = max_resets
+        # "unknown" until we have reset it ourselves, then "clean" until the
+        # next session starts pressing keys, when it becomes "used"
+        self.state = "unknown"
+        self.resets = ResetStats()
 
-    def press(self, code, show=False, timeout_seconds=0):
+    def press(self, code, show=False, timeout_seconds=0, learned=False):
+        """
+        Send a key and return what the display settles on, waiting up to
+        timeout_seconds for a blank display to show something. If that is
+        a learned deadline, say so: when it runs out, the blank is checked
+        for a few fresh frames before giving up, and the time is recorded
+        all the same, so that a deadline which was too short grows.
+        """
         name = BUTTON_NAMES[code]
         if show:
             self.display.write(f"{code} [{name}] Sent".ljust(16), line=0)
             self.display.write("  Waiting...".ljust(16), line=1)
-        self.presser.send(code)
-        time.sleep(0.25)
-        showing = Screen(self.reader.showing())
+        before = self.reader.last()
+        # the calculator may update the display while the key is still held,
+        # so count frames from the moment the key goes down
+        pressed = time.monotonic_ns()
+        with metrics.timer("press_seconds", phase="send"):
+            self.presser.send(code)
+        # return as soon as the display settles on something new. If it shows
+        # the same thing as before (or nothing) we cannot tell whether the key
+        # has taken effect yet, so give it the full settle time.
+        with metrics.timer("press_seconds", phase="settle"):
+            settled = self.reader.wait_stable(
+                pressed,
+                frames=SETTLE_FRAMES,
+                timeout=SETTLE_SECONDS,
+                exclude=(before, bytes(14)),
+            )
+            showing = Screen(settled or self.reader.showing())
 
         start_time = time.monotonic()
-        while showing == bytes(14) and time.monotonic() - start_time < timeout_seconds:
-            showing = Screen(self.reader.showing())
+        with metrics.timer("press_seconds", phase="compute"):
+            while (
+                showing == bytes(14)
+                and time.monotonic() - start_time < timeout_seconds
+            ):
+                showing = Screen(self.reader.showing())
+            if showing == bytes(14) and learned:
+                # make sure the display really is blank, or off, rather than
+                # about to show the answer, before giving up on the key
+                confirmed = self.reader.wait_stable(
+                    time.monotonic_ns(), frames=SETTLE_FRAMES, timeout=SETTLE_SECONDS
+                )
+                showing = Screen(confirmed or self.reader.showing())
+        metrics.count("keys", rig=self.name)
+        if showing == bytes(14) and learned:
+            metrics.count("deadline_overruns", rig=self.name)
+            logging.info(f"{name} still blank after {timeout_seconds:.2f}s")
+
+        if self.latencies is not None and (showing != bytes(14) or learned):
+            self.latencies.observe(code, before, (time.monotonic_ns() - pressed) / 1e9)
 
         hex = showing.hex()
 
@@ -169,6 +332,49 @@ class Calculator:
             print(showing.hex(" "))
             print(showing)
 
+    def reset(self):
+        """
+        Bring the calculator back to RESET_SCREEN as cheaply as we can:
+        nothing if it is still clean, a clear after a session, and the full
+        sequence if we do not know its state or a cheaper way failed.
+        """
+        start = time.monotonic()
+        showing = self.reader.showing()
+        if self.state == "clean" and showing == RESET_SCREEN:
+            way = "skipped"
+        elif self.state == "used" and showing != bytes(14):
+            way = "clear"
+        else:
+            # blank means switched off, asleep or still computing
+            way = "full"
+        retries = 0
+        while way != "skipped":
+            for key in RESETS[way]:
+                self.presser.send(BUTTON_CODES[key])
+            self.reader.flush()
+            if (badread := self.reader.showing()) == RESET_SCREEN:
+                break
+            metrics.count("bad_resets", rig=self.name, way=way)
+            if self.max_resets is not None and retries >= self.max_resets:
+                raise BadReset(
+                    f"{self.name} still showing {badread.hex()} after {retries} resets"
+                )
+            retries += 1
+            logging.warning(
+                f"got a bad {way} reset, showing {badread.hex()} instead of {RESET_SCREEN.hex()}"
+            )
+            if way == "clear":
+                way = "full"
+            else:
+                time.sleep(0.5)
+                way = "retry"
+        self.state = "clean"
+        seconds = time.monotonic() - start
+        self.resets.record(way, retries, seconds)
+        metrics.count("resets", rig=self.name, way=way)
+        metrics.observe("reset_seconds", seconds, way=way)
+        logging.info(f"{way} reset took {seconds:.2f} seconds")
+
     def session(self, codes):
         """
         >>> c = Calculator()
@@ -186,31 +392,36 @@ class Calculator:
                        0.
         """
         codes = str(codes)
-        self.presser.send(BUTTON_CODES["reset"])
-        self.presser.send(BUTTON_CODES["OFF"])
-        self.presser.send(BUTTON_CODES["ON/C"])
-        self.presser.send(BUTTON_CODES["reset"])
-        self.reader.flush()
-        while (
-            badread := self.reader.showing().hex()
-        ) != "600000fd00000000000000000000":
-            logging.warning(
-                f"got a bad reset, showing {badread} instead of 600000fd00000000000000000000"
-            )
-            time.sleep(0.5)
-            self.presser.send(BUTTON_CODES["reset"])
-            self.presser.send(BUTTON_CODES["OFF"])
-            self.presser.send(BUTTON_CODES["ON/C"])
+        self.reset()
+        if codes:
+            self.state = "used"
         # compute the whole list now so the calculator does
         # not fall asleep
         self.display.write(codes.ljust(16), line=0)
         self.display.write(("." * len(codes)).ljust(16), line=1)
         screens = []
-        # I timed the calculator at 9 seconds to do 300 choose 150
-        timeout = 0 if BUTTON_CODES["OFF"] in codes else 10
+        previous = RESET_SCREEN
+        off = False
         for i, code in enumerate(codes):
             self.display.write(codes[:i] + "_", line=1)
-            scr = self.press(code, timeout_seconds=timeout)
+            # nothing to wait for while the calculator is switched off
+            if code == BUTTON_CODES["OFF"]:
+                off = True
+            elif code == BUTTON_CODES["ON/C"]:
+                off = False
+            if off:
+                timeout = 0
+            elif self.latencies is None:
+                timeout = MAX_COMPUTE_SECONDS
+            else:
+                timeout = self.latencies.deadline(code, previous)
+            learned = not off and self.latencies is not None
+            scr = self.press(code, timeout_seconds=timeout, learned=learned)
+            if not off and scr == bytes(14):
+                logging.warning(
+                    f"{codes[:i+1]} still blank after {timeout:.2f} seconds"
+                )
+            previous = scr
             screens.append(scr)
             logging.info(f'{codes[:i+1]:<10} -> {scr.hex(" ")}')
 
@@ -0,0 +1,128 @@
+"""
+Fuzzing-style exploration: keep a corpus of sequences which reached a
+screen nobody had seen before, or a new combination of indicators, and
+spend key presses mutating and extending them, more often the more they
+found. An entry is mutated from the shortest sequence known to reach its
+screen, which may have turned up since the entry was added.
+
+>>> corpus = Corpus(["T", "C", "b"], seed=1)
+>>> corpus.observe("TC", [bytes.fromhex("6000003e00000000000000000000")] * 2)
+>>> [(entry.buttons, entry.energy) for entry in corpus.entries]
+[('T', 6)]
+>>> corpus.shortest[bytes.fromhex("6000003e00000000000000000000")]
+'T'
+>>> corpus.observe("b", [bytes.fromhex("6000003e00000000000000000008")])
+>>> [(entry.buttons, entry.energy) for entry in corpus.entries]
+[('T', 6), ('b', 6)]
+>>> len(corpus.mutant()) > 0
+True
+>>> two, three = (bytes.fromhex(f"600000{d}00000000000000000000") for d in ("3e", "7a"))
+>>> corpus.observe("CCT", [two, two, three])
+>>> corpus.source(corpus.entries[-1])
+'CCT'
+>>> corpus.observe("K", [three])
+>>> corpus.source(corpus.entries[-1])
+'K'
+"""
+
+from dataclasses import dataclass, field
+import logging
+import random
+
+# energy for reaching something new
+NEW_SCREEN = 1
+NEW_INDICATORS = 5
+# each time an entry is mutated it keeps this much of its energy
+DECAY = 0.9
+MIN_ENERGY = 0.1
+MAX_ENTRIES = 1000
+MAX_LENGTH = 20
+
+
+def indicators(screen):
+    "everything on the screen except the digits"
+    return (screen[0], screen[13], screen[1] & 0x80, screen[2] & 0x80)
+
+
+@dataclass(order=True)
+class Entry:
+    energy: float
+    buttons: str
+    screen: bytes = field(default=b"", compare=False)
+
+
+class Corpus:
+    def __init__(self, buttons, known=(), seed=None):
+        self.buttons = buttons
+        self.random = random.Random(seed)
+        self.entries = []
+        # the shortest sequence we have seen produce each screen
+        self.shortest = {}
+        self.seen = set(known)
+        self.seen_indicators = {indicators(s) for s in self.seen}
+
+    def observe(self, target, screens):
+        "learn from a finished session"
+        for i, screen in enumerate(screens, start=1):
+            screen = bytes(screen)
+            energy = 0
+            if screen not in self.seen:
+                self.seen.add(screen)
+                energy += NEW_SCREEN
+            if indicators(screen) not in self.seen_indicators:
+                self.seen_indicators.add(indicators(screen))
+                energy += NEW_INDICATORS
+            if len(self.shortest.get(screen, target[:i] + "_")) > i:
+                self.shortest[screen] = target[:i]
+            if energy:
+                logging.info(f"{target[:i]} reached something new, energy {energy}")
+                self.entries.append(Entry(energy, target[:i], screen))
+        if len(self.entries) > MAX_ENTRIES:
+            self.entries = sorted(self.entries)[-MAX_ENTRIES:]
+
+    def mutant(self):
+        "a new target, derived from a corpus entry picked by energy"
+        if not self.entries:
+            return "".join(self.random.choices(self.buttons, k=5))
+        (entry,) = self.random.choices(self.entries, [e.energy for e in self.entries])
+        entry.energy *= DECAY
+        if entry.energy < MIN_ENERGY:
+            self.entries.remove(entry)
+        mutation = self.random.choice(
+            # new states mostly lie beyond the end, so extend twice as often
+            [
+                self.extend,
+                self.extend,
+                self.replace,
+                self.insert,
+                self.delete,
+                self.splice,
+            ]
+        )
+        return mutation(self.source(entry))[:MAX_LENGTH] or self.extend("")
+
+    def source(self, entry):
+        "the shortest sequence known to reach what the entry reached"
+        return self.shortest.get(entry.screen, entry.buttons)
+
+    def extend(self, buttons):
+        tail = self.random.choices(self.buttons, k=self.random.randint(1, 5))
+        return buttons + "".join(tail)
+
+    def replace(self, buttons):
+        i = self.random.randrange(len(buttons))
+        return buttons[:i] + self.random.choice(self.buttons) + buttons[i + 1 :]
+
+    def insert(self, buttons):
+        i = self.random.randint(0, len(buttons))
+        return buttons[:i] + self.random.choice(self.buttons) + buttons[i:]
+
+    def delete(self, buttons):
+        i = self.random.randrange(len(buttons))
+        return buttons[:i] + buttons[i + 1 :]
+
+    def splice(self, buttons):
+        if not self.entries:
+            return self.extend(buttons)
+        other = self.source(self.random.choice(self.entries))
+        return buttons + other[self.random.randrange(len(other)) :]
@@ -0,0 +1,539 @@
+"""
+Storage for everything the calculator has shown.
+
+Sessions are stored as a trie: each row of `nodes` is one button press,
+pointing at the row for the presses which came before it, so a sequence
+shares its storage with all of its prefixes. Node 0 is the root, the
+freshly reset calculator. The `sessions` view reproduces the old flat
+table, one row per sequence, for exports and ad-hoc queries.
+
+There are far fewer distinct displays than presses, so each node refers
+to its screen by id in the `screens` table, which also keeps the decoded
+text and how many nodes show it.
+
+Triggers stamp every inserted or changed node with the next number in a
+sequence (`changed`), so that downstream copies can fetch only the rows
+which changed since they last synced.
+
+Other triggers keep `transitions` up to date: every key seen to take one
+screen to another, with how many nodes show it and the latest of them,
+so questions about the calculator as a state machine need no walk over
+the trie. Screen 0 (RESET) stands for the freshly reset calculator. The
+example is not repointed when it is forgotten, as finding another node
+with the same transition would mean a scan, so check that it still shows
+the screen before using it.
+
+>>> two, point, three = (
+...     Screen.fromhex(f"600000{digit}00000000000000000000")
+...     for digit in ("3e", "be", "7a")
+... )
+>>> con = connect(":memory:")
+>>> record(con, "TCb", [two, point, three])
+3
+>>> record(con, "TK", [two, two])
+1
+>>> request(con, ["TCbi", "TK"])
+5
+>>> path(con, find(con, "TCbi"))
+'TCbi'
+>>> con.execute("SELECT buttons, screen = ?, requested FROM sessions ORDER BY buttons", [two]).fetchall()
+[('T', 1, 1), ('TC', 0, 1), ('TCb', 0, 1), ('TCbi', None, 1), ('TK', 1, 1)]
+>>> producing(con, two)
+['T', 'TK']
+>>> count(con, "TC")
+3
+>>> forget(con, "TC")
+>>> con.execute("SELECT buttons, screen IS NULL FROM sessions ORDER BY buttons").fetchall()
+[('T', 0), ('TC', 1), ('TCb', 1), ('TCbi', 1), ('TK', 0)]
+>>> for text, hits in con.execute("SELECT text, hits FROM screens ORDER BY screen_id"):
+...     print(hits, text.split()) # doctest: +NORMALIZE_WHITESPACE
+2 ['DEG', '2']
+0 ['DEG', '2.']
+0 ['DEG', '3']
+>>> transitions(con, RESET)
+[(0, 'T', 1, 1, 1)]
+>>> transitions(con, 1)
+[(1, 'K', 1, 1, 4)]
+>>> [(screen, path(con, node), untried) for screen, node, untried in frontier(con, "TK")]
+[(0, '', 'K'), (1, 'TK', 'T')]
+>>> forget(con, "T")
+>>> con.execute("SELECT COUNT(*) FROM transitions").fetchone()
+(0,)
+>>> record(con, "TK", [two, two])
+2
+>>> rebuild_transitions(con)
+>>> transitions(con, 1)
+[(1, 'K', 1, 1, 4)]
+>>> record(con, "Tb", [two, three]) + record(con, "Kb", [two, three])
+3
+>>> forget(con, "Kb")
+>>> {screen: path(con, node) for screen, node, __ in frontier(con, "TK")}[3]
+'Tb'
+>>> since = cursor(con)
+>>> record(con, "TC", [two, three])
+1
+>>> [(buttons, screen == three) for buttons, screen, *_ in changes(con, since, cursor(con))]
+[('TC', True)]
+"""
+
+from calculator import Screen
+from collections import defaultdict
+import logging
+import sqlite3
+import time
+
+PATH = "xanthippe.db"
+ROOT = 0
+# the screen of the root node, in transitions
+RESET = 0
+VERSION = 6
+
+# the screen a node's parent shows, RESET for the root's children
+SOURCE = f"""SELECT CASE WHEN node_id = {ROOT} THEN {RESET} ELSE screen_id END
+    FROM nodes WHERE node_id = NEW.parent_id"""
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS screens(
+    screen_id INTEGER PRIMARY KEY,
+    screen BLOB NOT NULL UNIQUE,
+    text TEXT,
+    hits INTEGER NOT NULL DEFAULT 0)""",
+    """CREATE TABLE IF NOT EXISTS nodes(
+    node_id INTEGER PRIMARY KEY,
+    parent_id INTEGER REFERENCES nodes(node_id),
+    button_code TEXT NOT NULL,
+    requested BOOLEAN NOT NULL DEFAULT FALSE,
+    screen_id INTEGER REFERENCES screens(screen_id),
+    changed INTEGER,
+    UNIQUE(parent_id, button_code))""",
+    "CREATE INDEX IF NOT EXISTS by_change ON nodes(changed)",
+    """CREATE TRIGGER IF NOT EXISTS stamp_insert
+    AFTER INSERT ON nodes
+    BEGIN
+        UPDATE nodes SET changed = (SELECT COALESCE(MAX(changed), 0) + 1 FROM nodes)
+        WHERE node_id = NEW.node_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stamp_update
+    AFTER UPDATE OF screen_id, requested ON nodes
+    BEGIN
+        UPDATE nodes SET changed = (SELECT COALESCE(MAX(changed), 0) + 1 FROM nodes)
+        WHERE node_id = NEW.node_id;
+    END""",
+    f"""INSERT OR IGNORE INTO nodes(node_id, parent_id, button_code)
+    VALUES({ROOT}, NULL, '')""",
+    """CREATE INDEX IF NOT EXISTS pending
+    ON nodes(node_id) WHERE requested AND screen_id IS NULL""",
+    "CREATE INDEX IF NOT EXISTS showing ON nodes(screen_id)",
+    """CREATE TRIGGER IF NOT EXISTS count_hits
+    AFTER UPDATE OF screen_id ON nodes
+    BEGIN
+        UPDATE screens SET hits = hits - 1 WHERE screen_id = OLD.screen_id;
+        UPDATE screens SET hits = hits + 1 WHERE screen_id = NEW.screen_id;
+    END""",
+    # log of prefixes cleared by forget(), so a running Explorer can notice
+    """CREATE TABLE IF NOT EXISTS forgotten(
+    id INTEGER PRIMARY KEY,
+    prefix TEXT NOT NULL)""",
+    # targets being run by some explorer, so that others leave them alone
+    """CREATE TABLE IF NOT EXISTS leases(
+    target TEXT PRIMARY KEY,
+    worker TEXT NOT NULL,
+    expires REAL NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS leases_by_worker ON leases(worker)",
+    """CREATE TABLE IF NOT EXISTS transitions(
+    from_screen INTEGER NOT NULL,
+    button_code TEXT NOT NULL,
+    to_screen INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    example INTEGER NOT NULL,
+    PRIMARY KEY(from_screen, button_code, to_screen)) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS transitions_to ON transitions(to_screen)",
+    # how long each key took, see latency.py
+    """CREATE TABLE IF NOT EXISTS latencies(
+    code TEXT NOT NULL,
+    context TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY(code, context, bucket))""",
+    # each explorer's latest metrics, for listen.py's /metrics route
+    """CREATE TABLE IF NOT EXISTS metrics(
+    source TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL)""",
+    # a node's screen changing moves the press into it, from its parent's
+    # screen, and the presses out of it to its children's screens
+    f"""CREATE TRIGGER IF NOT EXISTS track_transitions
+    AFTER UPDATE OF screen_id ON nodes
+    WHEN OLD.screen_id IS NOT NEW.screen_id
+    BEGIN
+        UPDATE transitions SET count = count - 1
+        WHERE from_screen = ({SOURCE}) AND button_code = NEW.button_code
+        AND to_screen = OLD.screen_id;
+        INSERT INTO transitions(from_screen, button_code, to_screen, count, example)
+        SELECT ({SOURCE}), NEW.button_code, NEW.screen_id, 1, NEW.node_id
+        WHERE ({SOURCE}) IS NOT NULL AND NEW.screen_id IS NOT NULL
+        ON CONFLICT DO UPDATE SET count = count + 1, example = excluded.example;
+        UPDATE transitions SET count = count - 1
+        WHERE from_screen = OLD.screen_id AND (button_code, to_screen) IN (
+            SELECT button_code, screen_id FROM nodes WHERE parent_id = NEW.node_id);
+        INSERT INTO transitions(from_screen, button_code, to_screen, count, example)
+        SELECT NEW.screen_id, button_code, screen_id, 1, node_id FROM nodes
+        WHERE parent_id = NEW.node_id AND screen_id IS NOT NULL
+        AND NEW.screen_id IS NOT NULL
+        ON CONFLICT DO UPDATE SET count = count + 1, example = excluded.example;
+        DELETE FROM transitions WHERE count = 0 AND (from_screen = OLD.screen_id
+            OR from_screen = ({SOURCE}) AND button_code = NEW.button_code);
+    END""",
+    f"""CREATE VIEW IF NOT EXISTS sessions AS
+    WITH RECURSIVE paths(node_id, buttons) AS (
+        SELECT node_id, '' FROM nodes WHERE node_id = {ROOT}
+        UNION ALL
+        SELECT nodes.node_id, paths.buttons || nodes.button_code
+        FROM nodes JOIN paths ON nodes.parent_id = paths.node_id
+    )
+    SELECT node_id, buttons, screen, requested, changed
+    FROM paths JOIN nodes USING(node_id) LEFT JOIN screens USING(screen_id)
+    WHERE node_id != {ROOT}""",
+]
+
+
+def connect(path=PATH, timeout=3000, **kwargs):
+    con = sqlite3.connect(path, timeout=timeout, **kwargs)
+    # let readers carry on while the explorer or the web server is writing
+    con.execute("PRAGMA journal_mode = WAL")
+    migrate(con)
+    return con
+
+
+def migrate(con):
+    "bring the schema up to date, converting older layouts"
+    (version,) = con.execute("PRAGMA user_version").fetchone()
+    if version >= VERSION:
+        return
+    (kind,) = con.execute(
+        "SELECT type FROM sqlite_master WHERE name = 'sessions'"
+    ).fetchone() or (None,)
+    with con:
+        if kind == "table":
+            logging.warning("converting sessions table to nodes, this may take a while")
+            con.execute("ALTER TABLE sessions RENAME TO flat_sessions")
+        if version == 1:
+            logging.warning("moving screens into their own table, this may take a while")
+            con.execute("DROP INDEX pending")
+            con.execute("ALTER TABLE nodes RENAME COLUMN screen TO old_screen")
+            con.execute("ALTER TABLE nodes ADD COLUMN screen_id INTEGER")
+        if version in (1, 2):
+            con.execute("DROP VIEW sessions")
+            con.execute("ALTER TABLE nodes ADD COLUMN changed INTEGER")
+        for statement in SCHEMA:
+            con.execute(statement)
+        if kind == "table":
+            cur = con.execute(
+                """SELECT buttons, screen, COALESCE(requested, FALSE)
+                FROM flat_sessions ORDER BY LENGTH(buttons)"""
+            )
+            for buttons, screen, requested in cur.fetchall():
+                node = extend(con, buttons)[-1]
+                con.execute(
+                    "UPDATE nodes SET screen_id = ?, requested = ? WHERE node_id = ?",
+                    [screen and intern(con, screen), requested, node],
+                )
+            con.execute("DROP TABLE flat_sessions")
+        if version == 1:
+            cur = con.execute(
+                "SELECT DISTINCT old_screen FROM nodes WHERE old_screen IS NOT NULL"
+            )
+            for (screen,) in cur.fetchall():
+                con.execute(
+                    "UPDATE nodes SET screen_id = ? WHERE old_screen = ?",
+                    [intern(con, screen), screen],
+                )
+            con.execute("ALTER TABLE nodes DROP COLUMN old_screen")
+        con.execute("UPDATE nodes SET changed = node_id WHERE changed IS NULL")
+        if version < 5:
+            if version:
+                logging.warning(
+                    "counting transitions between screens, this may take a while"
+                )
+            rebuild_transitions(con)
+        con.execute(f"PRAGMA user_version = {VERSION}")
+
+
+def intern(con, screen):
+    "the id of a screen, adding it to the screens table if it is new"
+    query = "SELECT screen_id FROM screens WHERE screen = ?"
+    row = con.execute(query, [screen]).fetchone()
+    if row is None:
+        try:
+            text = str(Screen(screen))
+        except (ValueError, IndexError):
+            text = None
+        con.execute(
+            "INSERT OR IGNORE INTO screens(screen, text) VALUES(?, ?)", [screen, text]
+        )
+        row = con.execute(query, [screen]).fetchone()
+    (screen_id,) = row
+    return screen_id
+
+
+def find(con, buttons, parent=ROOT):
+    "the node for a button sequence, or None if it has never been stored"
+    for code in buttons:
+        row = con.execute(
+            "SELECT node_id FROM nodes WHERE parent_id = ? AND button_code = ?",
+            [parent, code],
+        ).fetchone()
+        if row is None:
+            return None
+        (parent,) = row
+    return parent
+
+
+def extend(con, buttons, parent=ROOT):
+    "the node for every prefix of a button sequence, creating any missing ones"
+    nodes = []
+    for code in buttons:
+        args = [parent, code]
+        query = "SELECT node_id FROM nodes WHERE parent_id = ? AND button_code = ?"
+        row = con.execute(query, args).fetchone()
+        if row is None:
+            con.execute(
+                "INSERT OR IGNORE INTO nodes(parent_id, button_code) VALUES(?, ?)",
+                args,
+            )
+            row = con.execute(query, args).fetchone()
+        (parent,) = row
+        nodes.append(parent)
+    return nodes
+
+
+def path(con, node):
+    "the button sequence leading to a node"
+    (buttons,) = con.execute(
+        """WITH RECURSIVE up(node_id, button_code, depth) AS (
+            SELECT parent_id, button_code, 0 FROM nodes WHERE node_id = ?
+            UNION ALL
+            SELECT parent_id, nodes.button_code, depth + 1
+            FROM nodes JOIN up USING(node_id)
+        )
+        SELECT COALESCE(GROUP_CONCAT(button_code, ''), '')
+        FROM (SELECT button_code FROM up ORDER BY depth DESC)""",
+        [node],
+    ).fetchone()
+    return buttons
+
+
+SUBTREE = """WITH RECURSIVE subtree(node_id) AS (
+    VALUES(?)
+    UNION ALL
+    SELECT nodes.node_id FROM nodes JOIN subtree ON nodes.parent_id = subtree.node_id
+)"""
+
+
+def record(con, buttons, screens):
+    "store the screen after each prefix of buttons, unless already known"
+    nodes = extend(con, buttons)
+    ids = [intern(con, bytes(s)) for s in screens]
+    cur = con.executemany(
+        "UPDATE nodes SET screen_id = ? WHERE node_id = ? AND screen_id IS NULL",
+        zip(ids, nodes),
+    )
+    return cur.rowcount
+
+
+def screen_count(con):
+    "how many distinct screens have been seen"
+    (n,) = con.execute("SELECT COUNT(*) FROM screens").fetchone()
+    return n
+
+
+def producing(con, screen):
+    "every sequence which has been seen to produce a screen"
+    cur = con.execute(
+        """SELECT node_id FROM nodes
+        WHERE screen_id = (SELECT screen_id FROM screens WHERE screen = ?)""",
+        [bytes(screen)],
+    )
+    return sorted(path(con, n) for (n,) in cur.fetchall())
+
+
+def request(con, sequences):
+    "mark every prefix of each sequence as requested"
+    nodes = {n for buttons in sequences for n in extend(con, buttons)}
+    cur = con.executemany(
+        "UPDATE nodes SET requested = TRUE WHERE node_id = ? AND NOT requested",
+        ((n,) for n in sorted(nodes)),
+    )
+    return cur.rowcount
+
+
+def count(con, buttons):
+    "how many sequences start with buttons"
+    node = find(con, buttons)
+    if node is None:
+        return 0
+    (n,) = con.execute(f"{SUBTREE} SELECT COUNT(*) FROM subtree", [node]).fetchone()
+    return n
+
+
+def subtree(con, buttons):
+    "every node whose sequence starts with buttons"
+    node = find(con, buttons)
+    if node is None:
+        return []
+    cur = con.execute(f"{SUBTREE} SELECT node_id FROM subtree", [node])
+    return [n for (n,) in cur]
+
+
+def clear(con, nodes):
+    "forget the screens shown at the given nodes"
+    cur = con.executemany(
+        "UPDATE nodes SET screen_id = NULL WHERE node_id = ? AND screen_id IS NOT NULL",
+        ((n,) for n in nodes),
+    )
+    return cur.rowcount
+
+
+def requeue(con, buttons):
+    "request a forgotten prefix again, and log it for any running Explorer"
+    con.execute(
+        "UPDATE nodes SET requested = TRUE WHERE node_id = ?", [find(con, buttons)]
+    )
+    con.execute("INSERT INTO forgotten(prefix) VALUES(?)", [buttons])
+
+
+def forget(con, buttons):
+    "clear the screens of every sequence starting with buttons, and request it again"
+    nodes = subtree(con, buttons)
+    if nodes:
+        clear(con, nodes)
+        requeue(con, buttons)
+
+
+def cursor(con):
+    "the latest change number, to pass as `since` on the next sync"
+    (latest,) = con.execute("SELECT COALESCE(MAX(changed), 0) FROM nodes").fetchone()
+    return latest
+
+
+def changes(con, since, until):
+    "(buttons, screen, requested, changed) for nodes changed in (since, until]"
+    cur = con.execute(
+        f"""SELECT node_id, screen, requested, changed
+        FROM nodes LEFT JOIN screens USING(screen_id)
+        WHERE changed > ? AND changed <= ? AND node_id != {ROOT}
+        ORDER BY changed""",
+        [since, until],
+    )
+    for node, screen, requested, changed in cur:
+        yield path(con, node), screen, requested, changed
+
+
+def rebuild_transitions(con):
+    "count the transitions table afresh from the nodes"
+    con.execute("DELETE FROM transitions")
+    con.execute(
+        f"""INSERT INTO transitions(from_screen, button_code, to_screen, count, example)
+        SELECT CASE WHEN p.node_id = {ROOT} THEN {RESET} ELSE p.screen_id END,
+            n.button_code, n.screen_id, COUNT(*), MAX(n.node_id)
+        FROM nodes AS n JOIN nodes AS p ON n.parent_id = p.node_id
+        WHERE n.screen_id IS NOT NULL
+        AND (p.screen_id IS NOT NULL OR p.node_id = {ROOT})
+        GROUP BY 1, 2, 3"""
+    )
+
+
+def transitions(con, screen_id):
+    "(from_screen, button_code, to_screen, count, example) for presses from a screen"
+    cur = con.execute(
+        "SELECT * FROM transitions WHERE from_screen = ? ORDER BY button_code, count",
+        [screen_id],
+    )
+    return cur.fetchall()
+
+
+def frontier(con, codes):
+    """
+    (screen_id, node, untried) for every screen seen from which some of
+    `codes` have never been pressed: node shows the screen, and untried
+    is the codes not yet pressed from it.
+    """
+    tried = defaultdict(set)
+    cur = con.execute("SELECT DISTINCT from_screen, button_code FROM transitions")
+    for screen_id, code in cur:
+        tried[screen_id].add(code)
+    # the example may have been forgotten since, but some node shows the
+    # screen, or the transition would be gone too
+    cur = con.execute(
+        """SELECT to_screen, COALESCE(
+            (SELECT node_id FROM nodes WHERE node_id = example AND screen_id = to_screen),
+            (SELECT node_id FROM nodes WHERE screen_id = to_screen LIMIT 1))
+        FROM (SELECT to_screen, MAX(example) AS example
+            FROM transitions GROUP BY to_screen)"""
+    )
+    found = []
+    for screen_id, node in [(RESET, ROOT)] + cur.fetchall():
+        untried = "".join(c for c in codes if c not in tried[screen_id])
+        if untried:
+            found.append((screen_id, node, untried))
+    return found
+
+
+def claim(con, targets, worker, seconds):
+    """
+    Lease whichever targets nobody else holds a live lease on, and return
+    those. Expiry times are wall-clock, so the hosts' clocks must agree.
+
+    >>> con = connect(":memory:")
+    >>> claim(con, ["TC", "TK"], "pi1", 60)
+    ['TC', 'TK']
+    >>> claim(con, ["TC", "Tb"], "pi2", 60)
+    ['Tb']
+    >>> release(con, ["TC"], "pi1")
+    >>> claim(con, ["TC", "TK"], "pi2", 60)
+    ['TC']
+    """
+    now = time.time()
+    con.execute("DELETE FROM leases WHERE expires < ?", [now])
+    claimed = []
+    for target in targets:
+        cur = con.execute(
+            """INSERT INTO leases(target, worker, expires) VALUES(?, ?, ?)
+            ON CONFLICT(target) DO UPDATE SET expires = excluded.expires
+            WHERE worker = excluded.worker""",
+            [target, worker, now + seconds],
+        )
+        if cur.rowcount:
+            claimed.append(target)
+    return claimed
+
+
+def leased(con, worker):
+    """
+    The targets others hold a live lease on, which claim() would refuse.
+
+    >>> con = connect(":memory:")
+    >>> claim(con, ["TC", "TK"], "pi1", 60)
+    ['TC', 'TK']
+    >>> sorted(leased(con, "pi2")), leased(con, "pi1")
+    (['TC', 'TK'], set())
+    """
+    cur = con.execute(
+        "SELECT target FROM leases WHERE worker != ? AND expires >= ?",
+        [worker, time.time()],
+    )
+    return {target for (target,) in cur}
+
+
+def renew(con, worker, seconds):
+    "extend every lease held by worker"
+    con.execute(
+        "UPDATE leases SET expires = ? WHERE worker = ?", [time.time() + seconds, worker]
+    )
+
+
+def release(con, targets, worker):
+    con.executemany(
+        "DELETE FROM leases WHERE target = ? AND worker = ?",
+        ((t, worker) for t in targets),
+    )
@@ -1,21 +1,30 @@
 import binascii
-import gpiozero
+from driver import gpio
 import time
 
+default_pins = {
+    "power": 20,
+    "enable": 21,
+    "data": [22, 23, 24, 25, 26, 27],
+}
+
 
 class ButtonPresser:
-    def __init__(self):
-        self.power = gpiozero.OutputDevice(20, initial_value=True)
-        self.enable = gpiozero.DigitalOutputDevice(
-            21, active_high=False, initial_value=False
+    def __init__(self, pins=default_pins, backend=None):
+        # see driver.gpio; the default is plain gpiozero
+        self.gpio = backend or gpio.Gpiozero()
+        self.power = self.gpio.output(pins["power"], initial_value=True)
+        self.enable = self.gpio.output(
+            pins["enable"], active_high=False, initial_value=False
         )
-        self.data = [gpiozero.OutputDevice(i) for i in range(22, 28)]
+        self.pins = pins["data"]
+        self.data = [self.gpio.output(i) for i in pins["data"]]
 
     def send(self, symbol):
         binary = binascii.a2b_base64("AAA" + symbol)[-1]
         values = (int(d) for d in f"{binary:06b}"[::-1])
-        for pin, value in zip(self.data, values):
-            pin.value = value
+        # all six at once, so the code is never half set
+        self.gpio.write(dict(zip(self.pins, values)))
         self.enable.blink(on_time=0.05, off_time=0.15, n=1, background=False)
         if symbol == "3":
             # reset takes additional time for some reason
@@ -1,4 +1,6 @@
 import gpiozero
+import metrics
+import threading
 import time
 
 default_pins = {
@@ -11,14 +13,39 @@ default_pins = {
     "d7": 19,
 }
 
+WIDTH = 16
+LINES = 2
+# display memory address of the first character of each line
+LINE_ADDRESS = [0x00, 0x40]
+
 
 class LCD:
     """
     Minimal driver for HD44780 character display.
     backlight pin is connected to a transistor, which turns
     the backlight on when high
+
+    Writing only updates a framebuffer, so it never waits for the display.
+    A worker thread sends the characters which differ from what the display
+    shows, so if several writes come in while it is busy only the latest
+    state gets drawn. With pins=None there is no display, and nothing is
+    sent at all.
+
+    >>> lcd = LCD(None)
+    >>> print(lcd.write("2+3=").write("5", line=1).write("  ok"))
+    2+3=
+    5  ok
     """
     def __init__(self, pins=default_pins):
+        # what callers have written, and where the next character goes
+        self.wanted = [[" "] * WIDTH for __ in range(LINES)]
+        self.cursor = (0, 0)
+        # notified when the framebuffer changes, and when it has been drawn
+        self.changed = threading.Condition()
+        self.enabled = pins is not None
+        if not self.enabled:
+            return
+
         self.backlight = gpiozero.PWMLED(pins["led"])
         self.data = [
             gpiozero.DigitalOutputDevice(pins[p]) for p in "d4 d5 d6 d7".split()
@@ -27,28 +54,88 @@ class LCD:
         self.select = gpiozero.DigitalOutputDevice(pins["rs"])
 
         # configuration
-        self.select.off()
         for byte in [
             0x33,  # 8 bit interface
             0x32,  # 8 bit interface
             0x28,  # 4 bit interface, 2 display lines, 8px font
             0x0C,  # display on, cursor off, blinking off
             0x06,  # left-to-right mode
+            0x01,  # clear
         ]:
-            self.send_byte(byte)
-        self.clear()
+            self.command(byte)
+        # what the display is showing; only the worker touches it
+        self.shown = [[" "] * WIDTH for __ in range(LINES)]
         self.backlight.value = 0.1
+        threading.Thread(target=self.draw, daemon=True).start()
+
+    def __str__(self):
+        return "\n".join("".join(row).rstrip() for row in self.wanted)
 
     def clear(self):
-        self.select.off()
-        self.send_byte(0x01)
+        with self.changed:
+            for row in self.wanted:
+                row[:] = " " * WIDTH
+            self.cursor = (0, 0)
+            self.changed.notify_all()
         return self
 
     def goto_line(self, line):
-        self.select.off()
-        self.send_byte(0x80 if line == 0 else 0xC0)
+        with self.changed:
+            self.cursor = (line, 0)
         return self
 
+    def write(self, message, line=None):
+        with self.changed:
+            if line is not None:
+                self.cursor = (line, 0)
+            line, column = self.cursor
+            for char in message:
+                # like the display, carry on past the edge where nobody sees
+                if column < WIDTH:
+                    self.wanted[line][column] = char
+                column += 1
+            self.cursor = (line, column)
+            self.changed.notify_all()
+        return self
+
+    def sync(self, timeout=None):
+        "wait until the display shows everything written so far"
+        with self.changed:
+            return not self.enabled or self.changed.wait_for(
+                lambda: self.shown == self.wanted, timeout
+            )
+
+    def draw(self):
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.shown != self.wanted)
+                wanted = [row[:] for row in self.wanted]
+            with metrics.timer("display_draw_seconds"):
+                self.send_changes(wanted)
+            with self.changed:
+                self.changed.notify_all()
+
+    def send_changes(self, wanted):
+        "bring the display up to `wanted`, sending only what differs"
+        for line, (want, shown) in enumerate(zip(wanted, self.shown)):
+            column = 0
+            while column < WIDTH:
+                if want[column] == shown[column]:
+                    column += 1
+                    continue
+                start = column
+                while column < WIDTH and want[column] != shown[column]:
+                    column += 1
+                self.command(0x80 | LINE_ADDRESS[line] + start)
+                self.select.on()
+                for char in want[start:column]:
+                    self.send_byte(ord(char))
+                shown[start:column] = want[start:column]
+
+    def command(self, byte):
+        self.select.off()
+        self.send_byte(byte)
+
     def clockpulse(self):
         """
         The sleep constants were determined empirically.
@@ -61,14 +148,6 @@ class LCD:
         time.sleep(0.0005)
         return self
 
-    def write(self, message, line=None):
-        if line is not None:
-            self.goto_line(line)
-        self.select.on()
-        for char in message:
-            self.send_byte(ord(char))
-        return self
-
     def send_byte(self, byte):
         lo = byte & 0xF
         hi = byte >> 4
@@ -83,4 +162,5 @@ if __name__ == "__main__":
     lcd = LCD()
     lcd.write("This is a test")
     lcd.write("of the LCD scrn.", line=1)
+    lcd.sync()
     time.sleep(1)
@@ -0,0 +1,173 @@
+"""
+Ways of driving the pins. Every backend sets pins up the same way and
+hands back devices with the gpiozero interface the drivers already use
+(on, off, value, blink, when_deactivated). What differs is the hot path:
+`write` sets several output pins at once, `read` takes one input level,
+and `shift_in` clocks a word in from a shift register. Levels are always
+the physical ones, whatever the device's active state.
+
+    gpiozero  works wherever gpiozero does, one pin at a time
+    gpiomem   registers mapped from /dev/gpiomem, whole masks at once;
+              BCM2835 to BCM2711 (Pi 1 to 4), pins 0 to 31 only
+    mock      no hardware: levels live in a dict, and hooks stand in for
+              whatever is on the other end of the wires
+
+>>> gpio = Mock()
+>>> clock = gpio.output(1)
+>>> data = gpio.input(2)
+>>> word = iter([1, 0, 1, 1])
+>>> gpio.hooks[1] = lambda level: level and gpio.levels.update({2: next(word, 0)})
+>>> gpio.levels[2] = 1
+>>> bin(gpio.shift_in(clock=1, data=2, bits=4))
+'0b1101'
+>>> gpio.write({3: 1, 4: 0})
+>>> gpio.levels[3], gpio.levels[4]
+(1, 0)
+"""
+
+import mmap
+import time
+
+
+class Gpiozero:
+    def __init__(self):
+        import gpiozero
+
+        self.gpiozero = gpiozero
+        self.devices = {}
+
+    def output(self, pin, active_high=True, initial_value=False):
+        device = self.gpiozero.DigitalOutputDevice(
+            pin, active_high=active_high, initial_value=initial_value
+        )
+        self.devices[pin] = device
+        return device
+
+    def input(self, pin, pull_up=True, edges=False):
+        "edges=True to be able to set when_activated and when_deactivated"
+        kind = self.gpiozero.DigitalInputDevice if edges else self.gpiozero.InputDevice
+        device = kind(pin, pull_up=pull_up)
+        self.devices[pin] = device
+        return device
+
+    def write(self, levels):
+        "set each pin in {pin: level}"
+        for pin, level in levels.items():
+            self.devices[pin].pin.state = level
+
+    def read(self, pin):
+        return self.devices[pin].pin.state
+
+    def shift_in(self, clock, data, bits):
+        "read `bits` bits, most significant first, pulsing clock after each"
+        result = 0
+        for i in range(bits - 1, -1, -1):
+            result |= self.read(data) << i
+            self.write({clock: 0})
+            self.write({clock: 1})
+        return result
+
+
+class Gpiomem(Gpiozero):
+    # register offsets, in 32-bit words, from the BCM2835 peripherals manual
+    GPSET0 = 0x1C // 4
+    GPCLR0 = 0x28 // 4
+    GPLEV0 = 0x34 // 4
+
+    def __init__(self, path="/dev/gpiomem"):
+        # gpiozero still sets up the pins: modes, pulls and interrupts
+        super().__init__()
+        with open(path, "r+b") as f:
+            self.mem = mmap.mmap(f.fileno(), 4096)
+        self.registers = memoryview(self.mem).cast("I")
+
+    def write(self, levels):
+        high = low = 0
+        for pin, level in levels.items():
+            if level:
+                high |= 1 << pin
+            else:
+                low |= 1 << pin
+        if high:
+            self.registers[self.GPSET0] = high
+        if low:
+            self.registers[self.GPCLR0] = low
+
+    def read(self, pin):
+        return self.registers[self.GPLEV0] >> pin & 1
+
+    def shift_in(self, clock, data, bits):
+        registers = self.registers
+        mask = 1 << clock
+        GPSET0, GPCLR0, GPLEV0 = self.GPSET0, self.GPCLR0, self.GPLEV0
+        result = 0
+        for i in range(bits - 1, -1, -1):
+            result |= (registers[GPLEV0] >> data & 1) << i
+            registers[GPCLR0] = mask
+            registers[GPSET0] = mask
+        return result
+
+
+class MockDevice:
+    def __init__(self, gpio, pin, active_high=True):
+        self.gpio = gpio
+        self.pin = pin
+        self.active_high = active_high
+        self.when_activated = None
+        self.when_deactivated = None
+
+    @property
+    def value(self):
+        return int(self.gpio.read(self.pin) == self.active_high)
+
+    @value.setter
+    def value(self, value):
+        self.gpio.write({self.pin: bool(value) == self.active_high})
+
+    def on(self):
+        self.value = 1
+
+    def off(self):
+        self.value = 0
+
+    def blink(self, on_time=1, off_time=1, n=None, background=True):
+        # only what the drivers use: a fixed number of blinks, in the foreground
+        for __ in range(n):
+            self.on()
+            time.sleep(on_time)
+            self.off()
+            time.sleep(off_time)
+
+
+class Mock(Gpiozero):
+    def __init__(self):
+        self.devices = {}
+        self.levels = {}
+        # called with the new level whenever a pin is written
+        self.hooks = {}
+
+    def output(self, pin, active_high=True, initial_value=False):
+        device = self.devices[pin] = MockDevice(self, pin, active_high)
+        device.value = initial_value
+        return device
+
+    def input(self, pin, pull_up=True, edges=False):
+        self.levels[pin] = int(pull_up)
+        device = self.devices[pin] = MockDevice(self, pin, active_high=not pull_up)
+        return device
+
+    def write(self, levels):
+        for pin, level in levels.items():
+            self.levels[pin] = int(level)
+            if pin in self.hooks:
+                self.hooks[pin](int(level))
+
+    def read(self, pin):
+        return self.levels[pin]
+
+
+BACKENDS = {"gpiozero": Gpiozero, "gpiomem": Gpiomem, "mock": Mock}
+
+
+def backend(name="gpiozero"):
+    return BACKENDS[name]()
@@ -1,15 +1,46 @@
-import gpiozero
+from array import array
+from driver import gpio
+import metrics
+import queue
+import threading
 import time
-from dataclasses import dataclass
 
 
 LCD_REFRESH_PERIOD = 24_000_000  # milliseconds -> nanoseconds
+# how many runs of identical frames to remember; a few minutes' worth
+RING_SIZE = 4096
+# how many rows may wait for the capture thread before we drop some
+BACKLOG = 256
+
+default_pins = {
+    "sample": 0,
+    "clock": 1,
+    "data": 2,
+    # in the order the calculator fires them
+    "triggers": [6, 5, 4, 3],
+}
+
+
+# each byte's bits spread out to every fourth bit: 0b11 -> 0b10001
+SPREAD = [sum((b >> i & 1) << 4 * i for i in range(8)) for b in range(256)]
+
+
+def spread(x):
+    return (
+        SPREAD[x & 0xFF]
+        | SPREAD[x >> 8 & 0xFF] << 32
+        | SPREAD[x >> 16 & 0xFF] << 64
+        | SPREAD[x >> 24 & 0xFF] << 96
+    )
 
 
 def normalize_reading(bits):
     """
     Pack the raw bits into one byte per segment. Discard the checksum.
-    
+
+    Each of the 28 columns becomes a nibble of the four rows' bits, first
+    row highest, so this interleaves the rows bit by bit.
+
     example:
     >>> normalize_reading([0b00000000010000000000000000000111,\
                            0b10000010100000000000000000001011,\
@@ -17,21 +48,39 @@ def normalize_reading(bits):
                            0b00000001100000000000000000001110]).hex(' ')
     '60 00 00 63 7a 00 00 00 00 00 00 00 00 00'
     """
-    rows = [f"{x>>4:028b}" for x in bits]
-    columns = zip(*rows)
-    paired = zip(*[iter(columns)] * 2)
-    return bytes(int("".join(a + b), base=2) for a, b in paired)
+    a, b, c, d = (x >> 4 for x in bits)
+    packed = spread(a) << 3 | spread(b) << 2 | spread(c) << 1 | spread(d)
+    return packed.to_bytes(14, "big")
+
+
+def normalize_readings(bits):
+    """
+    normalize_reading for many frames at once: an (n, 4) array of raw rows
+    in, an (n, 14) array of screens out. Needs numpy.
+
+    >>> normalize_readings([[0b00000000010000000000000000000111,
+    ...                      0b10000010100000000000000000001011,
+    ...                      0b10000011110000000000000000001101,
+    ...                      0b00000001100000000000000000001110]])[0].tobytes().hex(' ')
+    '60 00 00 63 7a 00 00 00 00 00 00 00 00 00'
+    """
+    import numpy
+
+    bits = numpy.asarray(bits, dtype=numpy.uint32)
+    columns = bits[:, :, None] >> numpy.arange(31, 3, -1, dtype=numpy.uint32) & 1
+    # (frame, row, column) -> (frame, column, row), then 8 bits to the byte
+    interleaved = columns.transpose(0, 2, 1).reshape(len(bits), 112)
+    return numpy.packbits(interleaved.astype(numpy.uint8), axis=1)
 
 
-@dataclass
 class LogEntry:
-    shown: int
-    start: int
-    end: int = None
+    __slots__ = ("shown", "start", "end", "frames")
 
-    def __post_init__(self):
-        if self.end is None:
-            self.end = self.start
+    def __init__(self, shown, start, end=None, frames=1):
+        self.shown = shown
+        self.start = start
+        self.end = start if end is None else end
+        self.frames = frames
 
     def duration(self):
         return (self.end - self.start) / 1e9
@@ -40,13 +89,88 @@ class LogEntry:
         return f"{self.shown.hex(' ')}\nstart={self.start}\nend  ={self.end}\nduration={self.duration()} sec"
 
 
+class Ring:
+    """
+    The last `size` runs of identical frames, in preallocated arrays. Only
+    the capture thread writes; readers take a consistent copy without a
+    lock by checking `version`, which is odd while a write is under way.
+
+    >>> ring = Ring(size=2)
+    >>> ring.newest() is None
+    True
+    >>> ring.append(b"a", 10)
+    >>> ring.extend(20)
+    >>> ring.append(b"b", 30)
+    >>> ring.append(b"c", 40)
+    >>> [(e.shown, e.start, e.end, e.frames) for e in ring.entries()]
+    [(b'b', 30, 30, 1), (b'c', 40, 40, 1)]
+    """
+
+    __slots__ = ("size", "shown", "start", "end", "frames", "count", "version")
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.shown = [None] * size
+        self.start = array("q", [0]) * size
+        self.end = array("q", [0]) * size
+        self.frames = array("Q", [0]) * size
+        # how many runs have ever been appended
+        self.count = 0
+        self.version = 0
+
+    def append(self, shown, time):
+        i = self.count % self.size
+        self.version += 1
+        self.shown[i] = shown
+        self.start[i] = self.end[i] = time
+        self.frames[i] = 1
+        self.count += 1
+        self.version += 1
+
+    def extend(self, time):
+        "one more frame of the newest run"
+        i = (self.count - 1) % self.size
+        self.version += 1
+        self.end[i] = time
+        self.frames[i] += 1
+        self.version += 1
+
+    def read(self, n):
+        "run number n, or None if it was never written or has been overwritten"
+        while True:
+            version = self.version
+            if version & 1:
+                time.sleep(0)
+                continue
+            if not max(self.count - self.size, 0) <= n < self.count:
+                return None
+            i = n % self.size
+            entry = LogEntry(self.shown[i], self.start[i], self.end[i], self.frames[i])
+            if self.version == version:
+                return entry
+
+    def newest(self):
+        return self.read(self.count - 1)
+
+    def entries(self, since=0):
+        for n in range(max(since, self.count - self.size), self.count):
+            entry = self.read(n)
+            if entry is not None:
+                yield entry
+
+
 class LCDReader:
-    def __init__(self):
-        self.sample = gpiozero.OutputDevice(0, active_high=False, initial_value=False)
-        self.clock = gpiozero.OutputDevice(1)
-        self.data = gpiozero.InputDevice(2, pull_up=True)
+    def __init__(self, pins=default_pins, backend=None):
+        # see driver.gpio; the default is plain gpiozero
+        self.gpio = backend or gpio.Gpiozero()
+        self.pins = pins
+        self.sample = self.gpio.output(
+            pins["sample"], active_high=False, initial_value=False
+        )
+        self.clock = self.gpio.output(pins["clock"])
+        self.data = self.gpio.input(pins["data"], pull_up=True)
         self.triggers = [
-            gpiozero.DigitalInputDevice(i, pull_up=True) for i in range(6, 2, -1)
+            self.gpio.input(i, pull_up=True, edges=True) for i in pins["triggers"]
         ]
         for i, trig in enumerate(self.triggers):
 
@@ -56,26 +180,54 @@ class LCDReader:
             trig.when_deactivated = interrupt
 
         self.partial_readings = []
-        self.log = []
+        self.log = Ring()
+        # where flush() last left the log
+        self.flushed = 0
+        # each distinct screen is stored once, however many runs show it
+        self.interned = {}
+        # counters, each written only by the thread which notices
+        self.dropped = 0  # rows the capture thread had no room for
+        self.partial = 0  # frames abandoned with some rows missing
+        self.bad_checksum = 0  # rows which failed their checksum
+        # rows waiting for the capture thread, as (time, trigger, bits)
+        self.rows = queue.Queue(BACKLOG)
+        # notified whenever a complete frame is recorded
+        self.updated = threading.Condition()
+        threading.Thread(target=self.capture, daemon=True).start()
 
     def on_interrupt(self, i):
         # get time ASAP, so that it is a more reliable number
         now = time.monotonic_ns()
+        # the row has to be read before the next trigger replaces it, but
+        # everything else can wait for the capture thread
+        with metrics.timer("reader_acquire_seconds"):
+            partial = self.acquire()
+        try:
+            self.rows.put_nowait((now, i, partial))
+        except queue.Full:
+            self.dropped += 1
 
+    def capture(self):
+        while True:
+            self.assemble(*self.rows.get())
+
+    def assemble(self, now, i, partial):
         # make sure the partial readings are consistent
         if (
             i == 0
             or len(self.partial_readings) != i
             or now > 6_000_000 + self.partial_readings[-1][0]
         ):
+            if self.partial_readings:
+                self.partial += 1
             self.partial_readings = []
             if i != 0:
                 return
 
-        # take a new reading
-        partial = self.acquire()
         checksum = 15 & ~partial
         if checksum != 8 >> i:
+            self.bad_checksum += 1
+            self.partial_readings = []
             return
         self.partial_readings.append((now, partial))
 
@@ -86,34 +238,69 @@ class LCDReader:
     def record(self):
         (time, *_), bits = zip(*self.partial_readings)
         showing = normalize_reading(bits)
+        showing = self.interned.setdefault(showing, showing)
+        if len(self.interned) > RING_SIZE:
+            self.interned = {showing: showing}
+        newest = self.log.newest()
         if (
-            self.log
-            and self.log[-1].shown == showing
-            and time - self.log[-1].end < 1.5 * LCD_REFRESH_PERIOD
+            newest
+            and newest.shown == showing
+            and time - newest.end < 1.5 * LCD_REFRESH_PERIOD
         ):
-            self.log[-1].end = time
+            self.log.extend(time)
         else:
-            self.log.append(LogEntry(showing, time))
+            self.log.append(showing, time)
+        with self.updated:
+            self.updated.notify_all()
 
     def acquire(self):
-        result = 0
         self.sample.off()
-        for i in range(31, -1, -1):
-            result |= self.data.value << i
-            self.clock.off()
-            self.clock.on()
+        bits = self.gpio.shift_in(self.pins["clock"], self.pins["data"], 32)
         self.sample.on()
-        return result
+        # the data line is pulled up, so a set bit reads low
+        return ~bits & 0xFFFFFFFF
 
     def flush(self):
-        "clear the log"
-        self.log = self.log[-1:]
+        "forget all but the most recent reading"
+        self.flushed = max(self.log.count - 1, 0)
+
+    def entries(self):
+        "the readings since the last flush, as far as the log goes back"
+        return self.log.entries(since=self.flushed)
+
+    def last(self):
+        "the most recent reading, without waiting for a fresh one"
+        entry = self.log.newest()
+        return entry.shown if entry else bytes(14)
+
+    def wait_stable(self, after, frames=3, timeout=0.5, exclude=()):
+        """
+        Wait for the display to settle on something new: `frames` consecutive
+        identical readings, all taken after `after` (a monotonic_ns time),
+        showing anything not in `exclude`. Returns None on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self.updated:
+            while True:
+                entry = self.log.newest()
+                if entry:
+                    if (
+                        entry.start >= after
+                        and entry.frames >= frames
+                        and entry.shown not in exclude
+                    ):
+                        return entry.shown
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.updated.wait(remaining)
 
     def showing(self, timeout=0.5):
         now = time.monotonic_ns()
         while (time.monotonic_ns() - now) / 1e9 < timeout:
-            if self.log and now - self.log[-1].end < 2 * LCD_REFRESH_PERIOD:
-                return self.log[-1].shown
+            entry = self.log.newest()
+            if entry and now - entry.end < 2 * LCD_REFRESH_PERIOD:
+                return entry.shown
             time.sleep(LCD_REFRESH_PERIOD / 1e9)
         return b'\00'*14
 
@@ -130,5 +317,5 @@ if __name__ == "__main__":
     bp.send("b")  # 3
     bp.send("j")  # 4
 
-    for entry in reader.log:
+    for entry in reader.entries():
         print(entry, end="\n\n")
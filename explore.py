@@ -1,10 +1,30 @@
-import sqlite3
-from calculator import Calculator, BUTTON_CODES
+import argparse
+import database
+from dataclasses import dataclass
+from calculator import BadReset, Calculator, BUTTON_CODES
+from corpus import Corpus
+from latency import LatencyModel
+import metrics
+from planner import Plan
+from scheduler import Scheduler
+from writer import Writer, orphaned
+import json
+import os
 import random
 import itertools
 import logging
+import operator
+import socket
+import threading
+import time
 
 BUTTONS = tuple(sorted(set(BUTTON_CODES.values()) - {BUTTON_CODES["reset"]}))
+# how long a claimed target stays reserved if its explorer stops renewing it
+LEASE_SECONDS = 60
+# share of rig time guaranteed to requests from the web, whatever they yield
+REQUESTED_FLOOR = 0.2
+# how many targets to gather before merging those which share prefixes
+PLAN_BATCH = 10
 strats = []
 
 
@@ -13,52 +33,323 @@ def strategy(func):
     return func
 
 
-class Explorer:
-    def __init__(self):
-        self.db = sqlite3.connect("xanthippe.db", timeout=3000)
-        self.calculator = Calculator()
-        self.strats = [strat(self) for strat in strats]
+class Coverage:
+    """
+    In-memory copy of which button sequences already have a screen, so that
+    strategies can test candidates without a database query each.
+    """
 
-    def already_covered(self, target):
+    def __init__(self, db):
+        self.db = db
+        self.seen = database.cursor(self.db)
+        with self.db:
+            (self.forgotten,) = self.db.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM forgotten"
+            ).fetchone()
+            cur = self.db.execute(
+                "SELECT buttons FROM sessions WHERE screen IS NOT NULL"
+            )
+            self.covered = {b for (b,) in cur}
+        logging.info(f"loaded {len(self.covered)} covered sequences")
+
+    def __contains__(self, buttons):
+        return buttons in self.covered
+
+    def add(self, buttons):
+        self.covered.add(buttons)
+
+    def refresh(self):
+        """
+        Drop anything forget.py has cleared since the last refresh, then add
+        whatever other explorers sharing the database have recorded.
+        """
         with self.db:
             cur = self.db.execute(
-                """SELECT EXISTS(
-                SELECT 1 FROM sessions
-                WHERE buttons = ?
-                AND screen IS NOT NULL)""",
-                [target],
+                "SELECT id, prefix FROM forgotten WHERE id > ? ORDER BY id",
+                [self.forgotten],
+            )
+            forgotten = cur.fetchall()
+            if forgotten:
+                # one pass over the covered set, however many were forgotten
+                prefixes = tuple(prefix for __, prefix in forgotten)
+                self.covered = {b for b in self.covered if not b.startswith(prefixes)}
+                self.forgotten = forgotten[-1][0]
+                logging.info(f"forgot coverage of {len(prefixes)} prefixes")
+            latest = database.cursor(self.db)
+            cur = self.db.execute(
+                """SELECT node_id FROM nodes
+                WHERE changed > ? AND changed <= ? AND screen_id IS NOT NULL""",
+                [self.seen, latest],
+            )
+            for (node,) in cur.fetchall():
+                self.covered.add(database.path(self.db, node))
+            self.seen = latest
+
+
+class Rig:
+    """
+    One calculator and how it has been behaving. A rig which fails too many
+    sessions in a row is quarantined, so it stops holding up the others.
+    """
+
+    def __init__(self, calculator, max_failures=3):
+        self.calculator = calculator
+        self.max_failures = max_failures
+        self.failures = 0
+        self.sessions = 0
+        self.quarantined = False
+
+    def succeeded(self):
+        self.failures = 0
+        self.sessions += 1
+
+    def failed(self, reason):
+        self.failures += 1
+        metrics.count("failed_sessions", rig=self.calculator.name)
+        logging.warning(f"{self.calculator.name} failed a session: {reason}")
+        if self.failures >= self.max_failures:
+            self.quarantined = True
+            logging.error(
+                f"quarantining {self.calculator.name} after {self.failures} "
+                f"failures in a row ({self.sessions} sessions completed)"
             )
-            (ans,) = cur.fetchone()
-        return ans
+
+
+@dataclass
+class Result:
+    "a finished session, waiting for the writer"
+
+    target: str
+    screens: list
+    source: str
+    seconds: float
+    # targets to release once it is saved
+    leases: list
+    written: int = 0
+    new_screens: int = 0
+
+
+class Explorer:
+    def __init__(self, rigs=({},), path=database.PATH):
+        # the rigs share the connection, the coverage and the strategies,
+        # taking turns through self.lock
+        self.lock = threading.RLock()
+        self.path = path
+        self.db = database.connect(path, check_same_thread=False)
+        self.latencies = LatencyModel(self.db)
+        # several hosts may share the database, each leasing its targets
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        # sessions earlier runs on this host saved only to their journals
+        for journal in orphaned(path, socket.gethostname()):
+            journal.replay(self.db)
+        # sessions are saved in the background, while the next ones run
+        self.writer = Writer(
+            path,
+            self.worker,
+            self.write,
+            self.saved,
+            operator.attrgetter("target", "screens"),
+        )
+        # with a single rig keep retrying resets forever, as there is
+        # nothing else to do
+        max_resets = 5 if len(rigs) > 1 else None
+        self.rigs = [
+            Rig(Calculator(rig, latencies=self.latencies, max_resets=max_resets))
+            for rig in rigs
+        ]
+        self.calculator = self.rigs[0].calculator
+        self.in_progress = set()
+        threading.Thread(target=self.keep_leases, daemon=True).start()
+        self.coverage = Coverage(self.db)
+        self.strats = [strat(self) for strat in strats]
+        self.scheduler = Scheduler(self.strats, floors={"requested": REQUESTED_FLOOR})
+        # which strategy each target in progress came from
+        self.sources = {}
+        # sessions planned but not yet started, and the shorter targets each
+        # one covers on the way
+        self.planned = []
+        self.riders = {}
+        # called with (target, screens) after each session is saved
+        self.observers = []
+        self.sessions = 0
+
+    def claim(self, targets):
+        "lease whichever targets no other explorer is working on, returning those"
+        with self.lock:
+            with self.db:
+                return database.claim(self.db, targets, self.worker, LEASE_SECONDS)
+
+    def release(self, targets):
+        with self.lock:
+            with self.db:
+                database.release(self.db, targets, self.worker)
+
+    def keep_leases(self):
+        "renew our leases while sessions run; they lapse if this process dies"
+        con = database.connect(self.path)
+        while True:
+            time.sleep(LEASE_SECONDS / 4)
+            with con:
+                database.renew(con, self.worker, LEASE_SECONDS)
+
+    def already_covered(self, target):
+        return target in self.coverage
+
+    def covered_by_session(self, target):
+        "whether a session chosen, planned or in progress will cover target"
+        sessions = itertools.chain(self.in_progress, self.planned, self.sources)
+        return any(s.startswith(target) for s in sessions)
+
+    def leased_for_session(self, target):
+        "whether target is leased as a session of ours, or one's rider"
+        if target in self.in_progress or target in self.sources:
+            return True
+        if target in self.planned:
+            return True
+        return any(target in riders for riders in self.riders.values())
 
     def get_target(self):
+        if not self.planned:
+            self.plan()
+        return self.planned.pop(0)
+
+    def plan(self):
+        "gather a batch of targets and merge those which share prefixes"
+        self.coverage.refresh()
+        targets = [self.candidate() for __ in range(PLAN_BATCH)]
+        plan = Plan(targets)
+        logging.info(plan.summary())
+        self.planned = plan.sessions
+        self.riders.update(plan.riders)
+        for target in targets:
+            if target not in self.riders:
+                self.sources.pop(target, None)
+
+    def candidate(self):
         while True:
+            strat = self.scheduler.choose()
+            logging.info(f"choosing next target using strategy {strat.__name__}")
             try:
-                strat = random.choice(self.strats)
-                logging.info(f"choosing next target using strategy {strat.__name__}")
                 target = next(strat)
             except StopIteration:
-                self.strats.remove(strategy)
+                logging.info(f"strategy {strat.__name__} is exhausted")
+                self.scheduler.remove(strat)
+                continue
+            if target is None:
+                self.scheduler.rest(strat)
                 continue
-            if target is not None and not self.already_covered(target):
+            if self.covered_by_session(target):
+                # the strategy may have claimed it; let it go, unless it is
+                # leased for one of our sessions already
+                if not self.leased_for_session(target):
+                    self.release([target])
+                continue
+            if self.already_covered(target):
+                # the strategy may have claimed it before it was covered
+                self.release([target])
+            elif self.claim([target]):
                 logging.info(f"chose target {target}")
+                self.sources[target] = strat.__name__
                 return target
 
-    def explore(self):
-        target = self.get_target()
-        screens = self.calculator.session(target)
-        buttons = (target[:i] for i in range(1, len(target) + 1))
-        data = ({"but": b, "scrn": bytes(s)} for b, s in zip(buttons, screens))
-        logging.info("saving session")
-        with self.db:
-            cur = self.db.executemany(
-                """INSERT INTO sessions(buttons, screen)
-                VALUES(:but, :scrn)
-                ON CONFLICT(buttons) WHERE screen IS NULL
-                DO UPDATE SET screen = :scrn""",
-                data,
-            )
-            logging.info(f"wrote {cur.rowcount} rows")
+    def explore(self, rig=None):
+        rig = rig or self.rigs[0]
+        with metrics.timer("explore_seconds", phase="target"):
+            with self.lock:
+                target = self.get_target()
+                self.in_progress.add(target)
+        start = time.monotonic()
+        handed_over = False
+        try:
+            with metrics.timer("explore_seconds", phase="session"):
+                screens = rig.calculator.session(target)
+            rig.succeeded()
+            with self.lock:
+                result = Result(
+                    target,
+                    screens,
+                    self.sources.pop(target),
+                    time.monotonic() - start,
+                    [target] + self.riders.pop(target, []),
+                )
+            # the target stays in progress, and leased, until it is saved
+            self.writer.put(result)
+            handed_over = True
+        except BadReset as e:
+            rig.failed(e)
+        finally:
+            if not handed_over:
+                with self.lock:
+                    self.in_progress.discard(target)
+                    self.sources.pop(target, None)
+                    self.release([target] + self.riders.pop(target, []))
+
+    def write(self, con, batch):
+        "save a batch of results; the writer calls this inside a transaction"
+        for result in batch:
+            known = database.screen_count(con)
+            result.written = database.record(con, result.target, result.screens)
+            result.new_screens = database.screen_count(con) - known
+        database.release(con, [t for r in batch for t in r.leases], self.worker)
+        self.latencies.save(con)
+        self.publish_metrics(con)
+        logging.info(
+            f"saved {len(batch)} sessions, {sum(r.written for r in batch)} rows, "
+            f"{sum(r.new_screens for r in batch)} new screens"
+        )
+
+    def saved(self, batch):
+        "credit the results once the writer has committed them"
+        self.latencies.committed()
+        with self.lock:
+            for result in batch:
+                target = result.target
+                for i in range(1, len(target) + 1):
+                    self.coverage.add(target[:i])
+                for observer in self.observers:
+                    observer(target, result.screens)
+                self.scheduler.credit(
+                    result.source,
+                    seconds=result.seconds,
+                    rows=result.written,
+                    screens=result.new_screens,
+                )
+                self.in_progress.discard(target)
+                self.sessions += 1
+                if self.sessions % 20 == 0:
+                    logging.info(self.scheduler.summary())
+                    for r in self.rigs:
+                        logging.info(f"{r.calculator.name} {r.calculator.resets}")
+                    for line in metrics.summary():
+                        logging.info(line)
+
+    def publish_metrics(self, con):
+        "share our metrics with listen.py; call inside a transaction on con"
+        if not metrics.enabled:
+            return
+        for rig in self.rigs:
+            reader, name = rig.calculator.reader, rig.calculator.name
+            metrics.gauge("reader_dropped_rows", reader.dropped, rig=name)
+            metrics.gauge("reader_partial_frames", reader.partial, rig=name)
+            metrics.gauge("reader_bad_checksums", reader.bad_checksum, rig=name)
+        metrics.publish(con, self.worker)
+
+    def run(self):
+        "explore on every rig at once, until they have all been quarantined"
+
+        def work(rig):
+            while not rig.quarantined:
+                self.explore(rig)
+
+        threads = [
+            threading.Thread(target=work, args=[rig], name=rig.calculator.name)
+            for rig in self.rigs
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.writer.flush()
 
 
 @strategy
@@ -86,41 +377,103 @@ def alphabetical_random_tail(explorer):
                 yield buttons + tail
 
 
+@strategy
+def coverage_guided(explorer):
+    with explorer.db:
+        known = [s for (s,) in explorer.db.execute("SELECT screen FROM screens")]
+    corpus = Corpus(BUTTONS, known)
+    explorer.observers.append(corpus.observe)
+    while True:
+        yield corpus.mutant()
+
+
 @strategy
 def requested(explorer):
     while True:
         with explorer.db:
+            # only the longest pending requests; running them covers the rest.
+            # Other explorers see the same requests, so each takes a random
+            # selection rather than all contending for the first few.
             cur = explorer.db.execute(
-                """SELECT buttons FROM sessions
-                WHERE requested = TRUE AND screen IS NULL
-                ORDER BY LENGTH(buttons) DESC
+                """SELECT node_id FROM nodes AS n
+                WHERE requested AND screen_id IS NULL
+                AND NOT EXISTS(
+                    SELECT 1 FROM nodes
+                    WHERE parent_id = n.node_id AND requested AND screen_id IS NULL)
+                ORDER BY RANDOM()
                 LIMIT 20"""
             )
-            buttons = cur.fetchall()
+            buttons = [database.path(explorer.db, n) for (n,) in cur.fetchall()]
+            taken = database.leased(explorer.db, explorer.worker)
+        # our other rigs may be running some already, and other explorers see
+        # the same requests, so only offer those nobody else has claimed.
+        # Each is claimed once chosen, not here: a lease held while waiting
+        # to be yielded would keep other explorers off it for nothing.
+        buttons = [
+            b for b in buttons if b not in taken and not explorer.covered_by_session(b)
+        ]
         if not buttons:
             yield None
-        for (b,) in buttons:
+        for b in buttons:
             yield b
 
 
+@strategy
+def frontier(explorer):
+    "press keys never yet pressed from a screen, after a sequence showing it"
+    while True:
+        with explorer.db:
+            found = database.frontier(explorer.db, BUTTONS)
+            random.shuffle(found)
+            targets = [
+                database.path(explorer.db, node) + random.choice(untried)
+                for __, node, untried in found[:20]
+            ]
+        targets = [t for t in targets if not explorer.already_covered(t)]
+        if not targets:
+            yield None
+        yield from targets
+
+
 @strategy
 def random_after_requested(explorer):
     while True:
         with explorer.db:
             cur = explorer.db.execute(
-                """SELECT buttons FROM sessions
-                WHERE requested = TRUE AND LENGTH(buttons) < 20
+                """SELECT node_id FROM nodes
+                WHERE requested
                 ORDER BY RANDOM()
                 LIMIT 1"""
             )
-            (buttons,) = cur.fetchone()
+            (node,) = cur.fetchone()
+            # every prefix of a request is requested too
+            buttons = database.path(explorer.db, node)[:19]
         for __ in range(10):
             tail = "".join(random.choices(BUTTONS, k=5))
             yield buttons + tail
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    ex = Explorer()
-    while True:
-        ex.explore()
+    parser = argparse.ArgumentParser(description="explore the calculator")
+    parser.add_argument(
+        "--rigs",
+        metavar="FILE",
+        help="JSON list of rigs to drive at once, see Calculator for the format",
+    )
+    parser.add_argument(
+        "--no-metrics",
+        action="store_true",
+        help="skip timing the hot paths, see metrics.py",
+    )
+    args = parser.parse_args()
+    if not args.no_metrics:
+        metrics.enable()
+    logging.basicConfig(
+        level=logging.INFO, format="%(threadName)s:%(levelname)s:%(message)s"
+    )
+    rigs = ({},)
+    if args.rigs:
+        with open(args.rigs) as f:
+            rigs = json.load(f)
+    ex = Explorer(rigs)
+    ex.run()
@@ -0,0 +1,283 @@
+"""
+A compact export of the whole database, smaller and quicker to read than
+backup.csv.gz, which a reader can memory-map and look prefixes up in
+without decompressing the rest.
+
+    python export.py [--db xanthippe.db] [--out backup.xan]
+    python export.py --to-csv backup.xan backup.csv.gz
+
+The layout, with every integer little-endian:
+
+    MAGIC
+    blocks    each BLOCK_ROWS rows, compressed with zlib
+    screens   the distinct screens, each after a byte giving its length,
+              compressed with zlib
+    index     for each block its offset, length and row count, then the
+              length (a varint) and button codes of its first sequence
+    trailer   offset and length of the screens, then of the index, and
+              MAGIC again
+
+Rows are the nodes of the trie in depth-first order, which is also the
+order of their button sequences, so each row only needs what is new
+since the one before:
+
+    varint    up << 1 | requested, where up is how many levels the row's
+              parent is above the previous row
+    byte      button code; if up > 0, its distance from the previous
+              sibling's code
+    varint    0 if no screen has been recorded, else 1 + its number
+    varint    the change number, zigzag-encoded as the difference from
+              the previous row's
+
+Every block starts afresh from its first sequence, as if the previous row
+were that sequence's parent, with a change number of 0 before it.
+
+>>> import tempfile
+>>> two, three = bytes.fromhex("6000007e00000000000000000000"), bytes(14)
+>>> con = database.connect(":memory:")
+>>> database.record(con, "TCb", [two, three, two])
+3
+>>> database.record(con, "TK", [two, two])
+1
+>>> database.request(con, ["Kb"])
+2
+>>> path = os.path.join(tempfile.mkdtemp(), "test.xan")
+>>> write(con, path, block_rows=2)
+>>> export = Export(path)
+>>> len(export), len(export.index)
+(6, 3)
+>>> [(b, s and s.hex()[:8], r) for b, s, r, __ in export.rows()]
+[('K', None, 1), ('Kb', None, 1), ('T', '6000007e', 0), ('TC', '00000000', 0), ('TCb', '6000007e', 0), ('TK', '6000007e', 0)]
+>>> [b for b, *__ in export.rows("TC")]
+['TC', 'TCb']
+>>> export.find("TK")[:3] == ("TK", two, 0), export.find("TKK")
+(True, None)
+>>> rows = con.execute("SELECT buttons, screen, requested, changed FROM sessions")
+>>> sorted(rows) == list(export.rows())
+True
+"""
+
+from bisect import bisect_right
+import argparse
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from backup import csv_gzip, write_atomically
+import database
+from database import ROOT
+
+EXPORT = "backup.xan"
+MAGIC = b"XANTHIP\x01"
+BLOCK_ROWS = 4096
+BLOCK = struct.Struct("<QII")
+TRAILER = struct.Struct("<QQQQ8s")
+
+# every node with its sequence, in depth-first order, children by button code
+DEPTH_FIRST = f"""WITH RECURSIVE dfs(node_id, buttons, screen_id, requested, changed)
+AS (
+    SELECT node_id, '', screen_id, requested, changed
+    FROM nodes WHERE node_id = {ROOT}
+    UNION ALL
+    SELECT n.node_id, dfs.buttons || n.button_code, n.screen_id, n.requested, n.changed
+    FROM nodes AS n JOIN dfs ON n.parent_id = dfs.node_id
+    ORDER BY 2
+)
+SELECT buttons, screen_id, requested, changed FROM dfs WHERE node_id != {ROOT}"""
+
+
+def varint(n):
+    out = bytearray()
+    while n > 0x7F:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def read_varint(data, pos):
+    "the varint at pos in data, and the position after it"
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def encode_block(rows, numbers):
+    "one block of (buttons, screen_id, requested, changed), numbering new screens"
+    out = bytearray()
+    previous = rows[0][0][:-1]
+    last_change = 0
+    for buttons, screen_id, requested, changed in rows:
+        depth = len(buttons)
+        up = len(previous) + 1 - depth
+        code = ord(buttons[-1])
+        if up:
+            code -= ord(previous[depth - 1])
+        out += varint(up << 1 | bool(requested))
+        out.append(code)
+        if screen_id is None:
+            out.append(0)
+        else:
+            out += varint(numbers.setdefault(screen_id, len(numbers)) + 1)
+        delta = (changed or 0) - last_change
+        out += varint(delta << 1 if delta >= 0 else ~delta << 1 | 1)
+        previous, last_change = buttons, changed or 0
+    return zlib.compress(out)
+
+
+def chunks(con, block_rows=BLOCK_ROWS):
+    "the export of the database on con, a block at a time"
+    yield MAGIC
+    offset = len(MAGIC)
+    index = bytearray()
+    numbers = {}  # screen_id -> its number in the export
+
+    def block(rows):
+        nonlocal offset
+        data = encode_block(rows, numbers)
+        first = rows[0][0].encode()
+        index.extend(BLOCK.pack(offset, len(data), len(rows)))
+        index.extend(varint(len(first)) + first)
+        offset += len(data)
+        return data
+
+    rows = []
+    for row in con.execute(DEPTH_FIRST):
+        rows.append(row)
+        if len(rows) == block_rows:
+            yield block(rows)
+            rows = []
+    if rows:
+        yield block(rows)
+
+    screens = dict(con.execute("SELECT screen_id, screen FROM screens"))
+    dictionary = bytearray()
+    for screen_id in numbers:  # in order of numbering
+        dictionary.append(len(screens[screen_id]))
+        dictionary += screens[screen_id]
+    dictionary = zlib.compress(dictionary)
+    yield dictionary
+    yield index
+    yield TRAILER.pack(
+        offset, len(dictionary), offset + len(dictionary), len(index), MAGIC
+    )
+
+
+def write(con, path=EXPORT, block_rows=BLOCK_ROWS):
+    "export the database on con to path"
+    write_atomically(path, chunks(con, block_rows))
+
+
+class Export:
+    "an export file, memory-mapped"
+
+    def __init__(self, path=EXPORT):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        *sections, magic = TRAILER.unpack(self.map[-TRAILER.size :])
+        if magic != MAGIC or self.map[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not an export")
+        self.screens_at, self.screens_length, index_at, index_length = sections
+        self.index = []  # (offset, length, rows)
+        self.firsts = []  # the first sequence in each block
+        pos, end = index_at, index_at + index_length
+        while pos < end:
+            self.index.append(BLOCK.unpack_from(self.map, pos))
+            pos += BLOCK.size
+            length, pos = read_varint(self.map, pos)
+            self.firsts.append(self.map[pos : pos + length].decode())
+            pos += length
+        self._screens = None
+
+    def __len__(self):
+        return sum(rows for __, __, rows in self.index)
+
+    @property
+    def screens(self):
+        "the screen dictionary, decompressed on first use"
+        if self._screens is None:
+            at, length = self.screens_at, self.screens_length
+            data = zlib.decompress(self.map[at : at + length])
+            self._screens = []
+            pos = 0
+            while pos < len(data):
+                self._screens.append(data[pos + 1 : pos + 1 + data[pos]])
+                pos += 1 + data[pos]
+        return self._screens
+
+    def block(self, i):
+        "(buttons, screen, requested, changed) for each row of block i"
+        offset, length, count = self.index[i]
+        data = zlib.decompress(self.map[offset : offset + length])
+        screens = self.screens
+        path = list(self.firsts[i][:-1])
+        changed = pos = 0
+        for __ in range(count):
+            head, pos = read_varint(data, pos)
+            up = head >> 1
+            code = data[pos]
+            pos += 1
+            depth = len(path) + 1 - up
+            if up:
+                code += ord(path[depth - 1])
+            del path[depth - 1 :]
+            path.append(chr(code))
+            number, pos = read_varint(data, pos)
+            delta, pos = read_varint(data, pos)
+            changed += ~(delta >> 1) if delta & 1 else delta >> 1
+            screen = screens[number - 1] if number else None
+            yield "".join(path), screen, head & 1, changed
+
+    def rows(self, prefix=""):
+        "every row whose sequence starts with prefix, in order"
+        first = max(bisect_right(self.firsts, prefix) - 1, 0)
+        for i in range(first, len(self.index)):
+            for row in self.block(i):
+                if row[0] < prefix:
+                    continue
+                if not row[0].startswith(prefix):
+                    return
+                yield row
+
+    def find(self, buttons):
+        "the row for exactly these buttons, or None"
+        row = next(self.rows(buttons), None)
+        return row if row and row[0] == buttons else None
+
+
+def to_csv(export, path):
+    "the same rows in the CSV format of backup.csv.gz, in trie order"
+    write_atomically(path, csv_gzip(export.rows()))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", default=database.PATH, help="database to export")
+    parser.add_argument("--out", default=EXPORT, help="where to write the export")
+    parser.add_argument(
+        "--to-csv",
+        nargs=2,
+        metavar=("EXPORT", "CSV"),
+        help="convert an export to the CSV format instead",
+    )
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    if args.to_csv:
+        to_csv(Export(args.to_csv[0]), args.to_csv[1])
+        logging.info(f"wrote {args.to_csv[1]} in {time.monotonic() - start:.1f}s")
+    else:
+        write(database.connect(args.db), args.out)
+        size = os.path.getsize(args.out)
+        logging.info(
+            f"wrote {args.out}, {size} bytes, in {time.monotonic() - start:.1f}s"
+        )
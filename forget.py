@@ -1,6 +1,10 @@
 from calculator import BUTTON_CODES
+import database
+import argparse
 
-import sqlite3
+# nodes cleared per transaction in batch mode, so the explorer and the web
+# server can get at the database in between
+CHUNK = 1000
 
 
 def decode(buttons):
@@ -8,34 +12,77 @@ def decode(buttons):
 
 def count(buttons, con):
     with con:
-        con.execute("PRAGMA case_sensitive_like = True;")
-        cursor = con.execute(
-            "SELECT COUNT(*) FROM sessions WHERE buttons LIKE (? || '%')", [buttons]
-        )
-        affected, = cursor.fetchone()
-        return affected
+        return database.count(con, buttons)
     
 
 def forget(buttons, con):
     with con:
-        con.execute("PRAGMA case_sensitive_like = True;")
-        con.execute(
-            "UPDATE sessions SET screen = NULL WHERE buttons LIKE (? || '%')", [buttons]
-        )
-        con.execute(
-            "UPDATE sessions SET requested = TRUE WHERE buttons = :start;", [buttons]
-        )
+        database.forget(con, buttons)
+
+
+def read_prefixes(lines, raw=False):
+    """
+    Parse a file of prefixes, one per line, either as button names
+    separated by spaces or as raw button codes. Blank lines and lines
+    starting with # are skipped.
+
+    >>> read_prefixes(["# after rewiring row 3", "2nd SIN", "", "1/x"])
+    [('2nd SIN', 'BF'), ('1/x', 'G')]
+    >>> read_prefixes(["BF"], raw=True)
+    [('BF', 'BF')]
+    """
+    prefixes = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            prefixes.append((line, line if raw else decode(line)))
+    return prefixes
+
+
+def forget_batch(prefixes, con, confirm=input):
+    """
+    Count what every prefix affects in one read, then clear all of them
+    in chunks so that no single transaction holds the lock for long.
+    """
+    with con:
+        affected = {buttons: database.subtree(con, buttons) for _, buttons in prefixes}
+    for name, buttons in prefixes:
+        print(f"{len(affected[buttons]):>10}  {name}")
+    nodes = sorted(set().union(*affected.values()))
+    answer = confirm(f"This will affect {len(nodes)} entries. Are you sure? Type y to continue > ")
+    if answer.lower().strip() != 'y':
+        print("chose not to make changes")
+        return
+    cleared = 0
+    for i in range(0, len(nodes), CHUNK):
+        with con:
+            cleared += database.clear(con, nodes[i : i + CHUNK])
+    with con:
+        for buttons in affected:
+            if affected[buttons]:
+                database.requeue(con, buttons)
+    print(f"successfully forgot {cleared} screens")
 
 
 if __name__ == "__main__":
-    buttons = input("Enter buttons to forget separated by spaces> ")
-    buttons = decode(buttons)
-    if buttons:
-        con = sqlite3.connect("xanthippe.db")
-        affected = count(buttons, con)
-        confirm = input(f"This will affect {affected} entries. Are you sure? Type y to continue > ").lower().strip()
-        if confirm == 'y':
-            forget(buttons, con)
-            print("successfully forgot specificed entries")
-        else:
-            print("chose not to make changes")
+    parser = argparse.ArgumentParser(description="forget recorded screens so they are measured again")
+    parser.add_argument("--batch", metavar="FILE", help="file of prefixes to forget, one per line")
+    parser.add_argument("--raw", action="store_true", help="the file has button codes rather than names")
+    args = parser.parse_args()
+
+    if args.batch:
+        with open(args.batch) as f:
+            prefixes = read_prefixes(f, raw=args.raw)
+        forget_batch(prefixes, database.connect())
+    else:
+        buttons = input("Enter buttons to forget separated by spaces> ")
+        buttons = decode(buttons)
+        if buttons:
+            con = database.connect()
+            affected = count(buttons, con)
+            confirm = input(f"This will affect {affected} entries. Are you sure? Type y to continue > ").lower().strip()
+            if confirm == 'y':
+                forget(buttons, con)
+                print("successfully forgot specificed entries")
+            else:
+                print("chose not to make changes")
@@ -0,0 +1,153 @@
+"""
+Learned response times for each key, so that a press only waits as long
+as that key has been seen to need instead of the worst case for any key.
+
+Times are kept as histograms with 10ms buckets, per button code and per
+class of the screen the key was pressed from.
+
+>>> bucket(0.004), bucket(0.255), bucket(9.3)
+(0, 25, 930)
+>>> quantile({0: 90, 25: 9, 930: 1}, 0.5)
+0.01
+>>> quantile({0: 90, 25: 9, 930: 1}, 0.999)
+9.31
+>>> context(bytes(14))
+'blank'
+>>> context(bytes.fromhex('600000fd00000000000000000000'))
+'plain'
+>>> context(bytes.fromhex('600000fd00000000000000000008'))
+'2nd'
+"""
+
+from calculator import Screen, BUTTON_NAMES, MAX_COMPUTE_SECONDS
+from collections import Counter, defaultdict
+import threading
+
+import database
+
+RESOLUTION = 0.01  # seconds per histogram bucket
+DEFAULT_DEADLINE = MAX_COMPUTE_SECONDS
+MIN_SAMPLES = 100
+QUANTILE = 0.999
+MARGIN = 1.5
+SLACK = 0.1  # seconds
+
+
+def bucket(seconds):
+    return int(seconds / RESOLUTION)
+
+
+def quantile(histogram, q):
+    "upper edge of the bucket containing the q-th quantile"
+    total = sum(histogram.values())
+    seen = 0
+    for b in sorted(histogram):
+        seen += histogram[b]
+        if seen >= q * total:
+            return round((b + 1) * RESOLUTION, 6)
+    return None
+
+
+def context(screen):
+    "coarse class of the screen a key was pressed from"
+    if not any(screen):
+        return "blank"
+    try:
+        if "Error" in str(Screen(screen)).replace(" ", ""):
+            return "error"
+    except ValueError:
+        return "unknown"
+    if screen[13] & 0x08:
+        return "2nd"
+    if screen[13] & 0x04:
+        return "hyp"
+    if screen[2] & 0x80:
+        return "paren"
+    return "plain"
+
+
+class LatencyModel:
+    def __init__(self, db):
+        self.db = db
+        with self.db:
+            cur = self.db.execute(
+                "SELECT code, context, bucket, count FROM latencies"
+            )
+            self.histograms = defaultdict(Counter)
+            for code, ctx, b, n in cur:
+                self.histograms[code, ctx][b] += n
+                self.histograms[code, None][b] += n
+        # the rigs observe while the explorer's writer saves
+        self.lock = threading.Lock()
+        self.unsaved = Counter()
+        # what the last save() wrote, to forget once it has been committed
+        self.saving = Counter()
+
+    def observe(self, code, before, seconds):
+        "record that `code` took `seconds` to settle when pressed from `before`"
+        ctx = context(before)
+        b = bucket(seconds)
+        with self.lock:
+            self.histograms[code, ctx][b] += 1
+            self.histograms[code, None][b] += 1
+            self.unsaved[code, ctx, b] += 1
+
+    def learned(self, code, ctx=None):
+        "deadline for `code` from screens of class `ctx`, if enough is known"
+        histogram = self.histograms.get((code, ctx))
+        if histogram and sum(histogram.values()) >= MIN_SAMPLES:
+            return quantile(histogram, QUANTILE) * MARGIN + SLACK
+        return None
+
+    def deadline(self, code, before):
+        "how long to wait for `code` to produce a non-blank screen"
+        for ctx in context(before), None:
+            if (seconds := self.learned(code, ctx)) is not None:
+                return seconds
+        return DEFAULT_DEADLINE
+
+    def save(self, con=None):
+        """
+        Write new observations; call inside a transaction on con or self.db,
+        and committed() once it commits. Until then they stay unsaved, so a
+        transaction which is rolled back loses nothing.
+        """
+        with self.lock:
+            self.saving = Counter(self.unsaved)
+        (con or self.db).executemany(
+            """INSERT INTO latencies(code, context, bucket, count)
+            VALUES(?, ?, ?, ?)
+            ON CONFLICT(code, context, bucket)
+            DO UPDATE SET count = count + excluded.count""",
+            ((*key, n) for key, n in self.saving.items()),
+        )
+
+    def committed(self):
+        "forget the observations the last save() wrote, now they are stored"
+        with self.lock:
+            self.unsaved -= self.saving
+            self.saving = Counter()
+
+    def report(self):
+        "print the learned distributions, in seconds"
+        print(
+            f"{'key':<8}{'context':<9}{'count':>8}{'p50':>8}{'p90':>8}"
+            f"{'p99':>8}{'p99.9':>8}{'max':>8}{'deadline':>10}"
+        )
+        for (code, ctx), histogram in sorted(
+            self.histograms.items(), key=lambda item: (item[0][0], item[0][1] or "")
+        ):
+            learned = self.learned(code, ctx)
+            print(
+                f"{BUTTON_NAMES[code]:<8}{ctx or '(all)':<9}"
+                f"{sum(histogram.values()):>8}"
+                + "".join(
+                    f"{quantile(histogram, q):>8.2f}" for q in (0.5, 0.9, 0.99, 0.999)
+                )
+                + f"{(max(histogram) + 1) * RESOLUTION:>8.2f}"
+                + (f"{learned:>10.2f}" if learned is not None else f"{'-':>10}")
+            )
+
+
+if __name__ == "__main__":
+    LatencyModel(database.connect()).report()
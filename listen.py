@@ -1,15 +1,218 @@
-from flask import Flask, request, send_file
-import sqlite3
+from flask import Flask, Response, request, send_file
+import atexit
+from backup import csv_gzip
+from collections import OrderedDict
+import database
 from explore import BUTTONS
+from export import EXPORT
+import metrics
+import os
+import queue
+import sqlite3
+import threading
+import time
 
 app = Flask(__name__)
 allowed_buttons = frozenset(BUTTONS)
 allowed_symbols = frozenset(allowed_buttons | {","})
 
 
+def coalesce(sequences):
+    """
+    Drop anything which is a prefix of another sequence; requesting the
+    longer one requests all of its prefixes anyway.
+
+    >>> coalesce({"TC", "T", "TCb", "K", ""})
+    ['K', 'TCb']
+    """
+    ordered = sorted(s for s in sequences if s)
+    return [s for s, t in zip(ordered, ordered[1:] + [""]) if not t.startswith(s)]
+
+
+class RequestWriter(threading.Thread):
+    """
+    The one connection which writes requests. Handlers only enqueue, and
+    requests arriving close together are committed in one transaction.
+    """
+
+    def __init__(
+        self, max_delay=1.0, max_batch=500, max_known=100_000, retry_seconds=5.0
+    ):
+        super().__init__(daemon=True)
+        self.queue = queue.SimpleQueue()
+        self.max_delay = max_delay
+        self.retry_seconds = retry_seconds
+        self.max_batch = max_batch
+        self.max_known = max_known
+        # sequences (and so all their prefixes) already marked requested
+        self.known = set()
+
+    def submit(self, sequences):
+        self.queue.put(sequences)
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def write(self, con, sequences):
+        waiting = time.perf_counter()
+        with con:
+            con.execute("BEGIN IMMEDIATE")
+            metrics.observe(
+                "db_lock_wait_seconds",
+                time.perf_counter() - waiting,
+                process="listen",
+            )
+            with metrics.timer("db_write_seconds", process="listen"):
+                return database.request(con, sequences)
+
+    def run(self):
+        con = database.connect()
+        stopping = False
+        while not stopping:
+            batch = set(self.queue.get() or ())
+            stopping = not batch
+            deadline = time.monotonic() + self.max_delay
+            while not stopping and len(batch) < self.max_batch:
+                try:
+                    sequences = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if sequences is None:
+                    stopping = True
+                else:
+                    batch.update(sequences)
+            new = [s for s in coalesce(batch) if s not in self.known]
+            if not new:
+                continue
+            while True:
+                try:
+                    updated = self.write(con, new)
+                    break
+                except sqlite3.Error:
+                    if stopping:
+                        app.logger.exception(f"gave up on {len(new)} requests")
+                        return
+                    app.logger.exception(
+                        f"could not write {len(new)} requests, "
+                        f"retrying in {self.retry_seconds}s"
+                    )
+                    time.sleep(self.retry_seconds)
+            app.logger.info(f"updated {updated} entries of the database for {len(new)} requests")
+            if len(self.known) > self.max_known:
+                self.known.clear()
+            self.known.update(new)
+
+
+class Lookup:
+    """
+    Recorded screens for every prefix of a sequence, read through a pool of
+    read-only connections, with the most recently used prefixes cached.
+    Whenever the database's change number moves on, cached prefixes whose
+    nodes were stamped since are dropped, whoever changed them.
+    """
+
+    def __init__(self, size=100_000):
+        self.size = size
+        self.pool = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()  # buttons -> (node, screen, text)
+        self.buttons = {}  # node -> buttons, for the cached nodes
+        # nothing is cached yet, so changes made before now need not be read
+        con = database.connect()
+        try:
+            self.seen = database.cursor(con)
+        finally:
+            con.close()
+
+    def connection(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return sqlite3.connect(
+                f"file:{database.PATH}?mode=ro", uri=True, check_same_thread=False
+            )
+
+    def invalidate(self, con):
+        latest = database.cursor(con)
+        with self.lock:
+            if latest <= self.seen:
+                return
+            cur = con.execute(
+                "SELECT node_id FROM nodes WHERE changed > ? AND changed <= ?",
+                [self.seen, latest],
+            )
+            for (node,) in cur:
+                if (buttons := self.buttons.pop(node, None)) is not None:
+                    del self.cache[buttons]
+            self.seen = latest
+
+    def remember(self, buttons, row, seen):
+        "cache row, unless invalidate() has moved on since `seen` and it may be stale"
+        with self.lock:
+            if self.seen != seen:
+                return
+            self.cache[buttons] = row
+            self.buttons[row[0]] = buttons
+            while len(self.cache) > self.size:
+                _, (node, *_) = self.cache.popitem(last=False)
+                del self.buttons[node]
+
+    def screens(self, buttons):
+        "(prefix, screen, text) for each prefix, with None for unrecorded ones"
+        con = self.connection()
+        try:
+            self.invalidate(con)
+            found = []
+            parent = database.ROOT
+            for i, code in enumerate(buttons, start=1):
+                with self.lock:
+                    row = self.cache.get(buttons[:i])
+                    if row is not None:
+                        self.cache.move_to_end(buttons[:i])
+                    seen = self.seen
+                if row is None:
+                    row = con.execute(
+                        """SELECT node_id, screen, text
+                        FROM nodes LEFT JOIN screens USING(screen_id)
+                        WHERE parent_id = ? AND button_code = ?""",
+                        [parent, code],
+                    ).fetchone()
+                    if row is None:
+                        break
+                    self.remember(buttons[:i], row, seen)
+                parent, screen, text = row
+                found.append((buttons[:i], screen, text))
+            unknown = range(len(found) + 1, len(buttons) + 1)
+            return found + [(buttons[:i], None, None) for i in unknown]
+        finally:
+            self.pool.put(con)
+
+
+writer = None
+lookup = None
+starting = threading.Lock()
+
+
+def started():
+    """
+    The request writer and the lookup cache, started on the first request
+    rather than on import, so that importing this module touches nothing.
+    """
+    global writer, lookup
+    with starting:
+        if writer is None:
+            metrics.enable()
+            writer = RequestWriter()
+            writer.start()
+            atexit.register(writer.stop)
+            lookup = Lookup()
+    return writer, lookup
+
+
 @app.route("/", methods=["POST"])
 def receive_buttons():
-    if request.content_length > 10_000:
+    if (request.content_length or 0) > 10_000:
         app.logger.warning(
             f"Received a request of length {request.content_length} bytes"
         )
@@ -20,34 +223,101 @@ def receive_buttons():
         return ""
 
     app.logger.info(f"Received a request to check {data}")
-    rows = sorted(
-        set(
-            (buttons[: i + 1],)
-            for buttons in data.split(",")
-            for i in range(len(buttons))
-        )
-    )
-
-    con = sqlite3.connect("xanthippe.db", timeout=3000)
-    with con:
-        cur = con.executemany(
-            """INSERT INTO sessions(buttons, requested)
-            VALUES(?, TRUE)
-            ON CONFLICT(buttons) WHERE requested = FALSE
-            DO UPDATE SET requested = TRUE""",
-            rows,
-        )
-        app.logger.info(f"updated {cur.rowcount} entries of the database")
-
+    metrics.count("requests_received")
+    writer, __ = started()
+    writer.submit(data.split(","))
     return ""
 
 
 @app.route("/", methods=["GET"])
 def deliver_database():
     return send_file(
-        "backup.csv.gz", as_attachment=True, attachment_filename="xanthippe.csv.gz"
+        "backup.csv.gz", as_attachment=True, download_name="xanthippe.csv.gz"
     )
 
 
+@app.route("/export", methods=["GET"])
+def deliver_export():
+    "the whole database in export.py's format, for readers which look up prefixes"
+    return send_file(EXPORT, as_attachment=True, download_name="xanthippe.xan")
+
+
+def lookup_response(sequences):
+    """
+    The recorded screens for each sequence, as raw hex and as rendered by
+    Screen. Anything not yet recorded is requested in the same round-trip.
+    """
+    if set("".join(sequences)) - allowed_buttons:
+        return {"error": "invalid buttons"}, 400
+    writer, lookup = started()
+    screens = {}
+    for buttons in sequences:
+        screens[buttons] = [
+            {"buttons": prefix, "screen": screen and screen.hex(), "text": text}
+            for prefix, screen, text in lookup.screens(buttons)
+        ]
+    requested = [
+        buttons
+        for buttons, prefixes in screens.items()
+        if any(p["screen"] is None for p in prefixes)
+    ]
+    if requested:
+        writer.submit(requested)
+    return {"screens": screens, "requested": requested}
+
+
+@app.route("/lookup", methods=["GET"])
+def lookup_buttons():
+    return lookup_response(request.args.get("buttons", "").split(","))
+
+
+@app.route("/lookup", methods=["POST"])
+def lookup_batch():
+    if (request.content_length or 0) > 10_000:
+        return {"error": "request too long"}, 413
+    return lookup_response(request.get_data(as_text=True).split(","))
+
+
+@app.route("/changes", methods=["GET"])
+def deliver_changes():
+    """
+    Only the rows which changed after the client's cursor, oldest first.
+    The X-Cursor header is the cursor to send next time. A first download
+    should use the full backup, and the largest value in its last column.
+    """
+    since = request.args.get("since", 0, type=int)
+    con = database.connect()
+    until = database.cursor(con)
+
+    def rows():
+        try:
+            yield from csv_gzip(database.changes(con, since, until))
+        finally:
+            con.close()
+
+    return Response(
+        rows(),
+        mimetype="application/gzip",
+        headers={
+            "Content-Disposition": f"attachment; filename=xanthippe-{since}-{until}.csv.gz",
+            "X-Cursor": str(until),
+        },
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def deliver_metrics():
+    "ours and whatever the explorers have published, for Prometheus to scrape"
+    __, lookup = started()
+    con = lookup.connection()
+    try:
+        snapshots = metrics.published(con)
+    finally:
+        lookup.pool.put(con)
+    snapshots.append((f"listen:{os.getpid()}", metrics.snapshot()))
+    return Response(metrics.prometheus(snapshots) + "\n", mimetype="text/plain")
+
+
 if __name__ == "__main__":
+    started()
     app.run(host="0.0.0.0")
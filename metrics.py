@@ -0,0 +1,197 @@
+"""
+Counters, gauges and timing histograms for the hot paths. Nothing is
+recorded until enable() is called; until then every call returns at once,
+and timer() hands back a shared do-nothing context manager.
+
+The explorer publishes its metrics to the database, where listen.py picks
+them up for its /metrics route, in Prometheus' text format.
+
+>>> enable()
+>>> count("keys", rig="left")
+>>> count("keys", 2, rig="left")
+>>> for seconds in 0.002, 0.003, 0.2:
+...     observe("press_seconds", seconds, phase="send")
+>>> print(prometheus([("explorer", snapshot())]))
+# TYPE xanthippe_keys_total counter
+xanthippe_keys_total{source="explorer",rig="left"} 3
+# TYPE xanthippe_press_seconds summary
+xanthippe_press_seconds{source="explorer",phase="send",quantile="0.5"} 0.004
+xanthippe_press_seconds{source="explorer",phase="send",quantile="0.9"} 0.256
+xanthippe_press_seconds{source="explorer",phase="send",quantile="0.99"} 0.256
+xanthippe_press_seconds_sum{source="explorer",phase="send"} 0.205
+xanthippe_press_seconds_count{source="explorer",phase="send"} 3
+>>> reset()
+"""
+
+from bisect import bisect_left
+from contextlib import nullcontext
+import json
+import threading
+import time
+
+PREFIX = "xanthippe_"
+# upper edges of the histogram buckets: 1 ms to 16 s, doubling every other
+# bucket, then the rest
+BOUNDS = [round(0.001 * 2 ** (i / 2), 6) for i in range(29)] + [float("inf")]
+QUANTILES = (0.5, 0.9, 0.99)
+
+enabled = False
+lock = threading.Lock()
+# (name, labels) -> value, where labels is a sorted tuple of (key, value)
+counters = {}
+gauges = {}
+# (name, labels) -> [count per bucket, sum]
+histograms = {}
+NULL = nullcontext()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def reset():
+    "forget everything and stop recording"
+    global enabled
+    enabled = False
+    with lock:
+        counters.clear()
+        gauges.clear()
+        histograms.clear()
+
+
+def count(name, n=1, **labels):
+    if not enabled:
+        return
+    key = name, tuple(sorted(labels.items()))
+    with lock:
+        counters[key] = counters.get(key, 0) + n
+
+
+def gauge(name, value, **labels):
+    if not enabled:
+        return
+    gauges[name, tuple(sorted(labels.items()))] = value
+
+
+def observe(name, seconds, **labels):
+    if not enabled:
+        return
+    key = name, tuple(sorted(labels.items()))
+    with lock:
+        if key not in histograms:
+            histograms[key] = [[0] * len(BOUNDS), 0]
+        histogram = histograms[key]
+        histogram[0][bisect_left(BOUNDS, seconds)] += 1
+        histogram[1] += seconds
+
+
+class Timer:
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+def timer(name, **labels):
+    "time a with block into the histogram `name`"
+    return Timer(name, labels) if enabled else NULL
+
+
+def quantile(buckets, q):
+    "upper edge of the bucket containing the q-th quantile"
+    total = sum(buckets)
+    seen = 0
+    for bound, n in zip(BOUNDS, buckets):
+        seen += n
+        if seen and seen >= q * total:
+            return bound
+    return None
+
+
+def snapshot():
+    "everything recorded so far, as something json can store"
+    with lock:
+        return {
+            "counters": [[n, dict(l), v] for (n, l), v in counters.items()],
+            "gauges": [[n, dict(l), v] for (n, l), v in gauges.items()],
+            "histograms": [
+                [n, dict(l), buckets[:], total]
+                for (n, l), (buckets, total) in histograms.items()
+            ],
+        }
+
+
+def summary():
+    "one line per histogram, for the log"
+    lines = []
+    histograms = sorted(
+        snapshot()["histograms"], key=lambda h: (h[0], list(h[1].items()))
+    )
+    for name, labels, buckets, total in histograms:
+        n = sum(buckets)
+        where = ",".join(f"{k}={v}" for k, v in labels.items())
+        lines.append(
+            f"{name}{{{where}}} n={n} mean={total / n * 1e3:.1f}ms "
+            + " ".join(
+                f"p{q * 100:g}={quantile(buckets, q) * 1e3:.0f}ms" for q in QUANTILES
+            )
+        )
+    return lines
+
+
+def publish(con, source):
+    "store our snapshot for listen.py; call inside a transaction on con"
+    con.execute(
+        "INSERT OR REPLACE INTO metrics(source, data, updated) VALUES(?, ?, ?)",
+        [source, json.dumps(snapshot()), time.time()],
+    )
+
+
+def published(con, max_age=3600):
+    "[(source, snapshot)] for every process which has published lately"
+    cur = con.execute(
+        "SELECT source, data FROM metrics WHERE updated > ?",
+        [time.time() - max_age],
+    )
+    return [(source, json.loads(data)) for source, data in cur]
+
+
+def prometheus(snapshots):
+    "Prometheus' text format for [(source, snapshot)]"
+
+    def series(name, source, labels, **extra):
+        labels = {"source": source, **labels, **extra}
+        inner = ",".join(f'{k}="{v}"' for k, v in labels.items())
+        return f"{PREFIX}{name}{{{inner}}}"
+
+    families = {}
+    for source, snap in snapshots:
+        for name, labels, value in snap["counters"]:
+            families.setdefault((f"{name}_total", "counter"), []).append(
+                f"{series(f'{name}_total', source, labels)} {value:g}"
+            )
+        for name, labels, value in snap["gauges"]:
+            families.setdefault((name, "gauge"), []).append(
+                f"{series(name, source, labels)} {value:g}"
+            )
+        for name, labels, buckets, total in snap["histograms"]:
+            lines = families.setdefault((name, "summary"), [])
+            for q in QUANTILES:
+                value = quantile(buckets, q)
+                lines.append(f"{series(name, source, labels, quantile=q)} {value:g}")
+            lines.append(f"{series(name + '_sum', source, labels)} {total:g}")
+            lines.append(f"{series(name + '_count', source, labels)} {sum(buckets)}")
+    out = []
+    for (name, kind), lines in families.items():
+        out.append(f"# TYPE {PREFIX}{name} {kind}")
+        out.extend(lines)
+    return "\n".join(out)
@@ -0,0 +1,63 @@
+"""
+Merge pending targets which share prefixes. A session records a screen
+for every prefix of its target, so there is no need to run a target
+which is a prefix of another: the longer session covers it, saving a
+reset and every press of the shorter one.
+
+>>> plan = Plan(["TCb", "TCbiK", "TCx", "K", "TCb"])
+>>> plan.sessions
+['K', 'TCbiK', 'TCx']
+>>> plan.riders["TCbiK"]
+['TCb']
+>>> plan.saved
+6
+"""
+
+
+class Trie:
+    "button sequences, stored one key per level"
+
+    def __init__(self, sequences=()):
+        self.children = {}
+        self.end = False
+        for sequence in sequences:
+            self.add(sequence)
+
+    def add(self, sequence):
+        node = self
+        for key in sequence:
+            node = node.children.setdefault(key, Trie())
+        node.end = True
+
+    def leaves(self, prefix=""):
+        "the sequences which are not a prefix of any other, in order"
+        if not self.children:
+            yield prefix
+        for key in sorted(self.children):
+            yield from self.children[key].leaves(prefix + key)
+
+
+class Plan:
+    """
+    The fewest sessions which cover every target: one for each leaf of
+    their trie. Every other target rides along on a session it is a
+    prefix of.
+    """
+
+    def __init__(self, targets):
+        targets = [t for t in targets if t]
+        self.sessions = list(Trie(targets).leaves())
+        self.riders = {session: [] for session in self.sessions}
+        for target in sorted(set(targets) - set(self.sessions)):
+            session = next(s for s in self.sessions if s.startswith(target))
+            self.riders[session].append(target)
+        # the presses, not counting resets, we would have spent otherwise
+        self.saved = sum(map(len, targets)) - sum(map(len, self.sessions))
+        self.targets = len(targets)
+
+    def summary(self):
+        return (
+            f"planned {len(self.sessions)} sessions for {self.targets} targets, "
+            f"saving {self.targets - len(self.sessions)} resets "
+            f"and {self.saved} presses"
+        )
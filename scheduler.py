@@ -0,0 +1,105 @@
+"""
+Share rig time between the strategies according to how much each has
+been finding: new rows, and especially new screens, per second the rig
+spends running its targets.
+
+Each pick is a discounted UCB1 bandit choice, so strategies which have
+gone stale lose their share over time and the others still get tried
+now and then. Some strategies can be guaranteed a floor, a minimum
+share of recent rig time, so requests from the web are never starved.
+
+>>> def good(): yield from ()
+>>> def bad(): yield from ()
+>>> sched = Scheduler([good, bad])
+>>> for _ in range(50):
+...     sched.credit("good", seconds=5, rows=10, screens=1)
+...     sched.credit("bad", seconds=5, rows=1, screens=0)
+>>> sched.choose().__name__
+'good'
+>>> sched = Scheduler([good, bad], floors={"bad": 0.3})
+>>> for _ in range(50):
+...     sched.credit("good", seconds=5, rows=10, screens=1)
+>>> sched.choose().__name__
+'bad'
+"""
+
+from dataclasses import dataclass
+import math
+import random
+import time
+
+# a new screen is worth this many new rows
+SCREEN_WEIGHT = 10
+
+
+@dataclass
+class Yield:
+    pulls: float = 0
+    seconds: float = 0
+    reward: float = 0
+
+    def rate(self):
+        return self.reward / self.seconds if self.seconds else 0
+
+    def decay(self, factor):
+        self.pulls *= factor
+        self.seconds *= factor
+        self.reward *= factor
+
+
+class Scheduler:
+    def __init__(self, strategies, floors={}, halflife=200, exploration=0.5):
+        self.strategies = list(strategies)
+        self.floors = floors
+        # each session's stats count for half as much `halflife` sessions on
+        self.decay = 0.5 ** (1 / halflife)
+        self.exploration = exploration
+        self.stats = {s.__name__: Yield() for s in self.strategies}
+        # strategies which recently had nothing to offer, and until when
+        self.resting = {}
+
+    def remove(self, strategy):
+        self.strategies.remove(strategy)
+
+    def choose(self):
+        now = time.monotonic()
+        ready = [s for s in self.strategies if self.resting.get(s.__name__, 0) <= now]
+        ready = ready or self.strategies
+        total = sum(stat.seconds for stat in self.stats.values())
+        for s in ready:
+            floor = self.floors.get(s.__name__, 0)
+            if self.stats[s.__name__].seconds < floor * total:
+                return s
+        untried = [s for s in ready if not self.stats[s.__name__].pulls]
+        if untried:
+            return random.choice(untried)
+        return max(ready, key=lambda s: self.score(s.__name__))
+
+    def score(self, name):
+        best = max(stat.rate() for stat in self.stats.values()) or 1
+        pulls = sum(stat.pulls for stat in self.stats.values())
+        stat = self.stats[name]
+        bonus = math.sqrt(math.log(max(pulls, 1)) / stat.pulls)
+        return stat.rate() / best + self.exploration * bonus
+
+    def rest(self, strategy, seconds=30):
+        "the strategy had nothing to offer, so leave it alone for a while"
+        self.resting[strategy.__name__] = time.monotonic() + seconds
+
+    def credit(self, name, seconds, rows, screens):
+        "what a session from strategy `name` found, and how long it took"
+        for stat in self.stats.values():
+            stat.decay(self.decay)
+        stat = self.stats[name]
+        stat.pulls += 1
+        stat.seconds += seconds
+        stat.reward += rows + SCREEN_WEIGHT * screens
+
+    def summary(self):
+        total = sum(stat.seconds for stat in self.stats.values()) or 1
+        return "rig time: " + ", ".join(
+            f"{name} {stat.seconds / total:.0%} ({stat.rate():.2f}/s)"
+            for name, stat in sorted(
+                self.stats.items(), key=lambda item: -item[1].seconds
+            )
+        )
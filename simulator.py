@@ -0,0 +1,183 @@
+"""
+A rig with no hardware. The drivers run unchanged on the mock GPIO
+backend, with a model calculator on the other end of the wires: the bus
+fires the LCD's four trigger interrupts every 24 ms, 1 ms apart, and
+shifts the model's screen out through the reader's sample and clock pins,
+as the display's shift register would, and the key codes the presser sets
+go to the model.
+
+If the bus thread itself is held up for long enough between rows that the
+reader must drop the frame, it counts the frame as late, so that the
+simulator's own hiccups can be told apart from the reader's losses.
+
+>>> two = bytes.fromhex("6000007e00000000000000000000")
+>>> calc = simulated(model=Model({"T": two}))
+>>> [screen.hex() for screen in calc.session("T")]
+['6000007e00000000000000000000']
+"""
+
+from calculator import BUTTON_CODES, RESET_SCREEN, Calculator
+from driver.lcdreader import LCD_REFRESH_PERIOD
+from functools import lru_cache
+import random
+import string
+import threading
+import time
+
+# the key codes are base64 digits
+ALPHABET = string.ascii_uppercase + string.ascii_lowercase + string.digits + "+/"
+# nanoseconds between a frame's rows: the reader drops a frame whose rows
+# are more than ROW_WINDOW apart, so leave plenty of room for sleep jitter
+ROW_GAP = 1_000_000
+ROW_WINDOW = 6_000_000
+# the digits 0 to 9, to make screens up from
+DIGITS = [0x7D, 0x60, 0x3E, 0x7A, 0x63, 0x5B, 0x5F, 0x71, 0x7F, 0x7B]
+
+
+@lru_cache(maxsize=4096)
+def rows(screen):
+    """
+    The four words the reader shifts in for a screen, checksums included:
+    the inverse of driver.lcdreader.normalize_reading.
+
+    >>> from driver.lcdreader import normalize_reading
+    >>> normalize_reading(rows(RESET_SCREEN)) == RESET_SCREEN
+    True
+    """
+    packed = int.from_bytes(screen, "big")
+    words = []
+    for row in range(4):
+        word = 0
+        for column in range(28):
+            word = word << 1 | packed >> 111 - 4 * column - row & 1
+        words.append(word << 4 | 15 & ~(8 >> row))
+    return tuple(words)
+
+
+def made_up(keys):
+    "a screen which is always the same for the same keys"
+    rng = random.Random(keys)
+    return bytes([0x60, 0, 0, *rng.choices(DIGITS, k=10), 0])
+
+
+class Model:
+    """
+    A stand-in calculator. `screens` maps the keys pressed since the last
+    clear to what they show; any others show a made-up screen. After each
+    key the display is blank while the model "computes", for
+    `latencies[code]` seconds or else `latency`.
+    """
+
+    def __init__(self, screens={}, latencies={}, latency=0.02):
+        self.screens = screens
+        self.latencies = latencies
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.keys = ""
+        self.on = True
+        self.screen = RESET_SCREEN
+        self.ready = 0
+        self.presses = 0
+
+    def press(self, code):
+        with self.lock:
+            self.presses += 1
+            if code in (BUTTON_CODES["reset"], BUTTON_CODES["ON/C"]):
+                self.keys = ""
+                self.on = True
+                self.screen = RESET_SCREEN
+            elif code == BUTTON_CODES["OFF"]:
+                self.on = False
+            elif self.on:
+                self.keys += code
+                self.screen = self.screens.get(self.keys) or made_up(self.keys)
+                self.ready = time.monotonic() + self.latencies.get(code, self.latency)
+
+    def showing(self):
+        with self.lock:
+            if not self.on or time.monotonic() < self.ready:
+                return bytes(14)
+            return self.screen
+
+
+class Bus:
+    "the display's end of an LCDReader's wires"
+
+    def __init__(self, reader, showing):
+        self.reader = reader
+        self.showing = showing
+        self.frames = 0
+        # frames with rows sent too far apart, through no fault of the reader
+        self.late = 0
+        self.words = rows(bytes(14))
+        self.row = 0
+        self.bits = 0
+        self.running = True
+        reader.gpio.hooks[reader.pins["sample"]] = self.on_sample
+        reader.gpio.hooks[reader.pins["clock"]] = self.on_clock
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        start = time.monotonic_ns()
+        frame = 0
+        while self.running:
+            self.words = rows(self.showing())
+            previous = None
+            late = False
+            for row in range(4):
+                due = start + frame * LCD_REFRESH_PERIOD + row * ROW_GAP
+                time.sleep(max(due - time.monotonic_ns(), 0) / 1e9)
+                self.row = row
+                now = time.monotonic_ns()
+                late = late or previous is not None and now - previous > ROW_WINDOW
+                previous = now
+                self.reader.triggers[row].when_deactivated()
+            self.frames += 1
+            self.late += late
+            # like the real display, carry on from the time it is now
+            frame = max(frame + 1, (time.monotonic_ns() - start) // LCD_REFRESH_PERIOD)
+
+    def stop(self):
+        "stop after the frame being sent, so that the counts hold still"
+        self.running = False
+        self.thread.join()
+
+    def put_bit(self):
+        # the line is pulled up, so a set bit reads low
+        self.reader.gpio.levels[self.reader.pins["data"]] = int(not self.bits >> 31)
+
+    def on_sample(self, level):
+        # the sample pin is active low, so acquire() latches on a high level
+        if level:
+            self.bits = self.words[self.row]
+            self.put_bit()
+
+    def on_clock(self, level):
+        if level:
+            self.bits = self.bits << 1 & 0xFFFFFFFF
+            self.put_bit()
+
+
+class Simulator:
+    "a model calculator wired to a Calculator built on the mock backend"
+
+    def __init__(self, calculator, model=None):
+        self.model = model or Model()
+        self.presser = calculator.presser
+        self.presser.gpio.hooks[self.presser.enable.pin] = self.on_enable
+        self.bus = Bus(calculator.reader, self.model.showing)
+
+    def on_enable(self, level):
+        # enable is active low; the code is on the data pins by then
+        if not level:
+            levels = self.presser.gpio.levels
+            code = sum(levels[pin] << i for i, pin in enumerate(self.presser.pins))
+            self.model.press(ALPHABET[code])
+
+
+def simulated(rig={}, model=None):
+    "a Calculator with a simulated calculator attached, as calc.simulator"
+    calculator = Calculator({"gpio": "mock", "display": None, **rig})
+    calculator.simulator = Simulator(calculator, model)
+    return calculator
@@ -0,0 +1,49 @@
+"""
+The calculator as a state machine: which keys lead from each screen to
+which, read from the transitions table that database.py keeps up to date.
+
+    python transitions.py            # screens with keys never pressed from them
+    python transitions.py --rebuild  # recount the table from the nodes
+"""
+
+import argparse
+import logging
+import time
+
+from calculator import BUTTON_CODES, BUTTON_NAMES
+import database
+
+KEYS = sorted(set(BUTTON_CODES.values()) - {BUTTON_CODES["reset"]})
+
+
+def report(con, limit):
+    "the screens with the most keys never pressed from them"
+    with con:
+        found = database.frontier(con, KEYS)
+        (edges,) = con.execute("SELECT COUNT(*) FROM transitions").fetchone()
+        print(f"{edges} transitions, {len(found)} screens with untried keys")
+        found.sort(key=lambda f: -len(f[2]))
+        for screen_id, node, untried in found[:limit]:
+            buttons = " ".join(BUTTON_NAMES[c] for c in database.path(con, node))
+            print(
+                f"{screen_id:>8}  {len(untried):>3} untried  "
+                f"after: {buttons or '(reset)'}"
+            )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--rebuild", action="store_true", help="recount the table from the nodes"
+    )
+    parser.add_argument("--limit", type=int, default=20, help="screens to list")
+    args = parser.parse_args()
+
+    con = database.connect()
+    if args.rebuild:
+        start = time.monotonic()
+        with con:
+            database.rebuild_transitions(con)
+        logging.info(f"rebuilt transitions in {time.monotonic() - start:.1f} seconds")
+    report(con, args.limit)
@@ -0,0 +1,218 @@
+"""
+Write-behind persistence for the explorer. Finished sessions are queued
+for a background thread, which saves whatever has piled up in a single
+transaction while the rigs carry on with their next targets.
+
+If the database stays locked for more than SPILL_SECONDS (say listen.py or
+a backup is holding it), or writing fails some other way, queued sessions
+are appended to a journal next to the database instead, and fsynced, so
+that they survive the process dying. The writer keeps retrying, and
+empties the journal once its contents are in the database.
+
+Each process has a journal of its own, named after its host and process
+id, as several may share the database. An explorer starting up replays
+the journals which processes on its host left behind when they died.
+
+>>> import tempfile
+>>> journal = Journal(os.path.join(tempfile.mkdtemp(), "test.journal"))
+>>> journal.append([("TC", [bytes(14), bytes.fromhex("6000007e00000000000000000000")])])
+>>> [(target, [s.hex() for s in screens]) for target, screens in journal.entries()]
+[('TC', ['0000000000000000000000000000', '6000007e00000000000000000000'])]
+>>> journal.clear()
+>>> list(journal.entries())
+[]
+>>> journal_path("data/xanthippe.db", "pi4:1234")
+'data/xanthippe.pi4.1234.journal'
+"""
+
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import database
+import metrics
+
+# sessions waiting to be written before explore() has to wait for the writer
+QUEUE_SIZE = 64
+# most sessions written in one transaction
+BATCH_SIZE = 32
+# how long to wait for the database's write lock before spilling to the journal
+SPILL_SECONDS = 5
+# how often to retry the database while sessions are only in the journal
+RETRY_SECONDS = 10
+
+
+def journal_path(path, worker):
+    "where the journal of `worker` (host:pid) for the database at `path` goes"
+    host, pid = worker.rsplit(":", 1)
+    return f"{os.path.splitext(path)[0]}.{host}.{pid}.journal"
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def orphaned(path, host):
+    "journals for the database at `path` left by processes on `host` which died"
+    base = os.path.splitext(path)[0]
+    prefix = f"{os.path.basename(base)}.{host}."
+    for name in sorted(os.listdir(os.path.dirname(base) or ".")):
+        if not (name.startswith(prefix) and name.endswith(".journal")):
+            continue
+        pid = name[len(prefix) : -len(".journal")]
+        if pid.isdigit() and not alive(int(pid)):
+            yield Journal(os.path.join(os.path.dirname(base), name))
+
+
+class Journal:
+    "append-only file of (target, screens), one JSON object per line"
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, sessions):
+        with open(self.path, "a") as f:
+            for target, screens in sessions:
+                screens = [bytes(s).hex() for s in screens]
+                f.write(json.dumps({"target": target, "screens": screens}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def entries(self):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # cut short by a crash; whatever was on it was never saved
+                logging.warning(f"skipping a damaged line in {self.path}")
+                continue
+            yield record["target"], [bytes.fromhex(s) for s in record["screens"]]
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def replay(self, con):
+        "write everything in the journal to con, then empty it"
+        entries = list(self.entries())
+        if not entries:
+            return
+        logging.warning(f"replaying {len(entries)} sessions from {self.path}")
+        with con:
+            for target, screens in entries:
+                database.record(con, target, screens)
+        self.clear()
+
+
+class Writer:
+    """
+    Saves items from put() on a thread of its own. `write(con, batch)` is
+    called inside a transaction with a list of items; once it commits,
+    `done(batch)` is called. `spill(item)` gives the (target, screens) to
+    journal for an item, in the journal of `worker`.
+    """
+
+    def __init__(self, path, worker, write, done, spill):
+        self.path = path
+        self.write = write
+        self.done = done
+        self.spill = spill
+        self.journal = Journal(journal_path(path, worker))
+        self.queue = queue.Queue(QUEUE_SIZE)
+        # items in the journal but not yet in the database
+        self.spilled = []
+        self.thread = threading.Thread(target=self.run, name="writer", daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        metrics.gauge("writer_queue", self.queue.qsize())
+        self.queue.put(item)
+
+    def flush(self):
+        "wait until everything put so far has been saved or journaled"
+        self.queue.join()
+
+    def take(self):
+        "the next batch, waiting for it unless there is a journal to retry"
+        try:
+            batch = [self.queue.get(timeout=RETRY_SECONDS if self.spilled else None)]
+        except queue.Empty:
+            return []
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        con = database.connect(self.path, timeout=SPILL_SECONDS)
+        while True:
+            batch = self.take()
+            try:
+                self.save(con, batch)
+            finally:
+                for __ in batch:
+                    self.queue.task_done()
+
+    def save(self, con, batch):
+        if self.spilled:
+            # keep the journal in order behind what is already there
+            self.journal.append(map(self.spill, batch))
+            metrics.count("writer_journaled", len(batch))
+            self.spilled += batch
+            batch = self.spilled
+        waiting = time.perf_counter()
+        try:
+            with con:
+                con.execute("BEGIN IMMEDIATE")
+                metrics.observe(
+                    "db_lock_wait_seconds",
+                    time.perf_counter() - waiting,
+                    process="explorer",
+                )
+                with metrics.timer("db_write_seconds", process="explorer"):
+                    self.write(con, batch)
+        except Exception as e:
+            # whatever went wrong, the sessions must not be lost, nor the
+            # thread: explore() would wait on the full queue forever
+            if self.spilled:
+                logging.info(f"still unable to save journaled sessions: {e}")
+                return
+            if isinstance(e, sqlite3.OperationalError) and "locked" in str(e):
+                logging.warning(
+                    f"database locked for {SPILL_SECONDS}s, journaling sessions "
+                    f"to {self.journal.path}"
+                )
+            else:
+                logging.exception(f"journaling sessions to {self.journal.path}")
+            self.journal.append(map(self.spill, batch))
+            metrics.count("writer_journaled", len(batch))
+            self.spilled = batch
+            return
+        if self.spilled:
+            logging.info(f"saved {len(self.spilled)} journaled sessions")
+            self.journal.clear()
+            self.spilled = []
+        try:
+            self.done(batch)
+        except Exception:
+            # they are saved, so carry on regardless
+            logging.exception(f"after saving {len(batch)} sessions")